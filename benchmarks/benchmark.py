@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import shutil
+import platform
+import datetime
+import tempfile
+import subprocess
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'reportgeneration'), ROOT]
+
+import xarray as xr
+import dask
+from NPGridder import NPGridder
+from XGridder import XGridder
+from EKGridder import EKGridder
+from WeightCache import WeightCache
+from Metrics import Metrics
+from Scheduler import Scheduler, addSchedulerArguments
+import Reportgenerator as rg
+from synthetic import makeSurvey
+
+"""
+    End to end benchmark on a synthetic survey
+
+    The gridders, the Reportgenerator stages and the output writers are timed on
+    a survey from synthetic.py, and the wall time, the throughput (pings/s, MB/s)
+    and the peak memory (RSS of the process and its children) of every stage are
+    appended to a json history. The stages are measured with Metrics, as in a run.
+    Each run is compared with the last run in the history with the same settings,
+    so regressions show up between commits. The history is kept per machine and
+    not committed, the timings of different hosts do not compare.
+
+    python benchmarks/benchmark.py --pings 20000 --samples 1000
+    python benchmarks/benchmark.py --check 1.2   (exit status 1 when a stage is 20 % slower)
+"""
+
+
+class Benchmark:
+
+    def __init__(self, survey, pings, nbytes):
+        """
+        survey : directory with the synthetic survey
+        pings  : number of pings of the survey
+        nbytes : bytes of sv of one frequency
+        """
+        self.survey = survey
+        self.pings = pings
+        self.nbytes = nbytes
+        self.stages = {}
+
+    def stage(self, name, func, pings=None, nbytes=None):
+        """
+        Run func and record it as stage name, with pings and nbytes processed, the survey by default
+        """
+        pings = self.pings if pings is None else pings
+        nbytes = self.nbytes if nbytes is None else nbytes
+        # Only this stage, and the stages it runs, in the metrics
+        Metrics().reset()
+        with Metrics().stage(name):
+            result = func()
+        m = Metrics().stages[name]
+        self.stages[name] = {'seconds': m['wall_s'],
+                             'pings_per_s': pings / m['wall_s'],
+                             'mb_per_s': nbytes / 1024**2 / m['wall_s'],
+                             'peak_rss_mb': m['peak_rss_mb']}
+        print('{:<28} {:8.2f} s {:12.0f} pings/s {:9.1f} MB/s {:9.0f} MB'.format(
+            name, m['wall_s'], pings / m['wall_s'], nbytes / 1024**2 / m['wall_s'], m['peak_rss_mb']))
+        return result
+
+    def gridders(self, vstep, hstep, max_pings):
+        """
+        NPGridder on the first max_pings pings in memory, XGridder and EKGridder on the survey
+        """
+        sv = xr.open_zarr(os.path.join(self.survey, 'S_sv.zarr')).sel(frequency=38000)
+        r = sv['range'].values
+        target_v = np.arange(r[0], r[-1], vstep)
+
+        n = min(max_pings, self.pings)
+        data = sv['sv'].isel(ping_time=slice(0, n)).values.astype(float)
+        WeightCache().clear()
+        g = NPGridder(target_v, r, np.arange(0, n, hstep), np.arange(n))
+        self.stage('NPGridder', lambda: g.regrid(data), n, data.nbytes)
+        del data
+
+        WeightCache().clear()
+        g = XGridder(xr.DataArray(target_v), xr.DataArray(r),
+                     xr.DataArray(np.arange(0, self.pings, hstep)), xr.DataArray(np.arange(self.pings)))
+        self.stage('XGridder', lambda: g.regrid(sv['sv'].fillna(0)).compute())
+
+        # The per ping variables of the sv that Reportgenerator.applyMask passes on
+        sv = sv.drop_vars(['angle_alongship', 'angle_athwartship'])
+        WeightCache().clear()
+        self.stage('EKGridder', lambda: EKGridder(sv, 'range', vstep, 'start', 'ping', hstep, 0, r[-1]).regrid().compute())
+
+    def report(self, dst, vstep, hstep, window=None):
+        """
+        The Reportgenerator stages, and the writers of the report in dst
+        """
+        WeightCache().clear()
+        out = os.path.join(dst, 'S_report.zarr')
+        sv, labels, bottom = [os.path.join(self.survey, f) for f in ['S_sv.zarr', 'S_labels.zarr', 'S_bottom.zarr']]
+
+        rep = self.stage('Reportgenerator setup', lambda: rg.Reportgenerator(
+            sv, labels, bottom, out, 38000, -100, 'depth', vstep, 'start', 'ping', hstep, 0, 500, window=window))
+        self.stage('saveGridd', lambda: rep.saveGridd(out))
+
+        # The writers get the size of the report
+        size = rep.getGridd()['value'].nbytes
+        self.stage('saveImages', lambda: rep.saveImages(os.path.join(dst, 'S_report.png')), nbytes=size)
+        self.stage('saveReport csv', lambda: rep.saveReport(os.path.join(dst, 'S_report.csv')), nbytes=size)
+        try:
+            import pyarrow
+            self.stage('saveReport parquet', lambda: rep.saveReport(os.path.join(dst, 'S_report.parquet')), nbytes=size)
+        except ImportError:
+            print('pyarrow is not installed, parquet is not benchmarked')
+        self.stage('saveReport xml', lambda: rep.saveReport(os.path.join(dst, 'S_report.xml')), nbytes=size)
+
+
+def commit():
+    """
+    The commit of the code being benchmarked
+    """
+    if os.getenv('COMMIT_SHA'):
+        return os.getenv('COMMIT_SHA')
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'NA'
+
+
+def compareHistory(history, run, tolerance):
+    """
+    Print the change of each stage since the last run with the same config,
+    and return the stages that are more than tolerance times slower
+    """
+    previous = [h for h in history if h['config'] == run['config']]
+    if not previous:
+        print('No earlier run with these settings')
+        return []
+
+    last = previous[-1]
+    print('\nChange since {} ({})'.format(last['commit'], last['date']))
+    slower = []
+    for name, stage in run['stages'].items():
+        if name not in last['stages']:
+            continue
+        ratio = stage['seconds'] / last['stages'][name]['seconds']
+        memory = stage['peak_rss_mb'] / last['stages'][name]['peak_rss_mb']
+        flag = ''
+        if tolerance is not None and ratio > tolerance:
+            slower.append(name)
+            flag = 'SLOWER'
+        print('{:<28} time x{:5.2f}  memory x{:5.2f}  {}'.format(name, ratio, memory, flag))
+    return slower
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the gridders and the report on a synthetic survey')
+    parser.add_argument("--pings", type=int, default=20000, help="Pings of the synthetic survey")
+    parser.add_argument("--samples", type=int, default=1000, help="Range samples per ping")
+    parser.add_argument("--categories", type=int, default=3, help="Number of categories")
+    parser.add_argument("--frequencies", type=int, default=2, help="Number of frequencies")
+    parser.add_argument("--heave", type=float, default=1.0, help="Heave amplitude (m)")
+    parser.add_argument("--vstep", type=float, default=5, help="Channel thickness (m)")
+    parser.add_argument("--hstep", type=int, default=50, help="Pings per Time bin")
+    parser.add_argument("--window", type=int, help="Time bins gridded and written at a time")
+    parser.add_argument("--np_pings", type=int, default=20000, help="Pings gridded in memory by NPGridder")
+    parser.add_argument("--survey", type=str, help="Directory of the synthetic survey, kept between runs. Default a temporary directory")
+    parser.add_argument("--history", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.json'),
+                        help="Json file the results are appended to, kept per machine and ignored by git")
+    parser.add_argument("--check", type=float, help="Exit with status 1 when a stage is this many times slower than the last run")
+    addSchedulerArguments(parser)
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in ['pings', 'samples', 'categories', 'frequencies', 'heave',
+                                            'vstep', 'hstep', 'window', 'np_pings', 'scheduler', 'workers']}
+    tmp = tempfile.mkdtemp()
+    survey = args.survey or os.path.join(tmp, 'survey')
+
+    with Scheduler.fromArgs(args):
+        if not os.path.exists(os.path.join(survey, 'S_sv.zarr')):
+            with Metrics().stage('survey'):
+                makeSurvey(survey, args.pings, args.samples, args.categories, args.frequencies, args.heave)
+            print('Synthetic survey written in {:.1f} s'.format(Metrics().stages['survey']['wall_s']))
+
+        bench = Benchmark(survey, args.pings, args.pings * args.samples * 4)
+        bench.gridders(args.vstep, args.hstep, args.np_pings)
+        bench.report(tmp, args.vstep, args.hstep, args.window)
+
+    shutil.rmtree(tmp)
+
+    run = {'commit': commit(),
+           'date': datetime.datetime.now().astimezone().replace(microsecond=0).isoformat(),
+           'host': platform.node(),
+           'cpus': os.cpu_count(),
+           'python': platform.python_version(),
+           'versions': {m.__name__: m.__version__ for m in [np, xr, dask]},
+           'config': config,
+           'stages': bench.stages}
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    slower = compareHistory(history, run, args.check)
+
+    with open(args.history, 'w') as f:
+        json.dump(history + [run], f, indent=1)
+    print('Results appended to {}'.format(args.history))
+
+    sys.exit(1 if slower else 0)
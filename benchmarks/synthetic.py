@@ -0,0 +1,93 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array as da
+
+"""
+    Synthetic survey in the layout of the preprocessed CRIMAC files
+
+    <dst>/S_sv.zarr     : sv (frequency, ping_time, range) with the per ping draft, heave and distance
+    <dst>/S_labels.zarr : annotation (category, ping_time, range) probabilities
+    <dst>/S_bottom.zarr : bottom_range (ping_time, range), 1 below the bottom
+
+    The arrays are random, drawn chunk by chunk from a seed, so any size can be
+    written without holding the survey in memory, and the same seed gives the same survey.
+"""
+
+FREQUENCIES = [18000, 38000, 70000, 120000, 200000, 333000]
+
+
+def makeSurvey(dst, pings=10000, samples=1000, categories=3, frequencies=2, heave=1.0,
+               sample_range=0.19, ping_chunk=2000, seed=0):
+    """
+    Write a synthetic survey to the directory dst, returns the number of bytes of sv.
+    pings        : number of pings, about one per second and 0.002 nmi
+    samples      : range samples per ping, sample_range m apart
+    categories   : acoustic categories of the labels, numbered 1, 2, ... with 27 (sandeel) last
+    frequencies  : number of frequencies, 38 kHz is always one of them
+    heave        : amplitude of the heave in m
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(dst, exist_ok=True)
+
+    freqs = sorted([38000] + [f for f in FREQUENCIES if f != 38000][:frequencies - 1])
+    cats = list(range(1, categories)) + [27]
+    chunks = (ping_chunk, samples)
+
+    ping_time = pd.Timestamp('2019-05-01').to_datetime64() + \
+        (np.cumsum(rng.uniform(0.8, 1.2, pings)) * 1e9).astype('timedelta64[ns]')
+    distance = np.cumsum(rng.uniform(0.0015, 0.0025, pings))
+    r = np.arange(samples) * sample_range
+
+    # Layers and schools: sv falls off with range, with heavy tailed noise
+    state = da.random.RandomState(seed)
+    profile = da.from_array(np.exp(-r / (r[-1] + 1))[None, :], chunks=(1, samples))
+    sv = da.stack([(state.random_sample((pings, samples), chunks=chunks) ** 4 * 1e-5 * profile).astype('float32')
+                   for _ in freqs])
+
+    bottom_index = (samples * 0.8 + samples * 0.1 * np.sin(np.arange(pings) / 500)).astype(int)
+    bottom = da.from_array(bottom_index, chunks=ping_chunk)[:, None] <= da.arange(samples, chunks=samples)[None, :]
+
+    ds = xr.Dataset(
+        {'sv': (('frequency', 'ping_time', 'range'), sv),
+         'angle_alongship': (('frequency', 'ping_time', 'range'), da.zeros_like(sv)),
+         'angle_athwartship': (('frequency', 'ping_time', 'range'), da.zeros_like(sv)),
+         'transducer_draft': (('frequency', 'ping_time'), np.full((len(freqs), pings), 6.0) + rng.normal(0, 0.05, (len(freqs), pings))),
+         'heave': (('ping_time',), heave * np.sin(np.arange(pings) / 7.0)),
+         'distance': (('ping_time',), distance)},
+        coords={'frequency': freqs,
+                'ping_time': ping_time,
+                'range': r,
+                'channel_id': (('frequency',), ['GPT {} kHz'.format(f // 1000) for f in freqs]),
+                'latitude': (('ping_time',), 60 + np.cumsum(rng.normal(2e-5, 1e-6, pings))),
+                'longitude': (('ping_time',), 5 + np.cumsum(rng.normal(3e-5, 1e-6, pings)))},
+        attrs={'name': 'synthetic survey', 'seed': seed})
+    ds.chunk({'frequency': 1}).to_zarr(os.path.join(dst, 'S_sv.zarr'), mode='w')
+
+    annotation = da.stack([state.random_sample((pings, samples), chunks=chunks).astype('float32') for _ in cats])
+    labels = xr.Dataset({'annotation': (('category', 'ping_time', 'range'), annotation)},
+                        coords={'category': cats, 'ping_time': ping_time, 'range': r})
+    labels.chunk({'category': 1}).to_zarr(os.path.join(dst, 'S_labels.zarr'), mode='w')
+
+    bot = xr.Dataset({'bottom_range': (('ping_time', 'range'), da.where(bottom, 1.0, np.nan))},
+                     coords={'ping_time': ping_time, 'range': r})
+    bot.to_zarr(os.path.join(dst, 'S_bottom.zarr'), mode='w')
+
+    return sv.nbytes
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a synthetic survey')
+    parser.add_argument("--dst", type=str, help="Directory of the survey")
+    parser.add_argument("--pings", type=int, default=10000, help="Number of pings")
+    parser.add_argument("--samples", type=int, default=1000, help="Range samples per ping")
+    parser.add_argument("--categories", type=int, default=3, help="Number of categories")
+    parser.add_argument("--frequencies", type=int, default=2, help="Number of frequencies")
+    parser.add_argument("--heave", type=float, default=1.0, help="Heave amplitude (m)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    makeSurvey(args.dst, args.pings, args.samples, args.categories, args.frequencies, args.heave, seed=args.seed)
@@ -0,0 +1,162 @@
+import os
+import glob
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+import zarr
+from xml2zarr import report_xml2xarrays, FREQUENCY_FIELDS, MISSING
+
+
+'''
+    Convert a directory of LSSS reports (ListUserFile*.xml) to one zarr store
+
+    The reports are parsed in a process pool, each in one pass that reads all
+    its frequencies. The store has a frequency dimension and is sorted on Time.
+    Files are recognised by a hash of their content, so a file that is already
+    in the store is skipped, and the store is only extended with the new files.
+    New files after the end of the store are appended, anything else rewrites it.
+'''
+
+# Fill of the frequency settings where a frequency has no distance
+FILL = {name: MISSING[dtype] for name, dtype in FREQUENCY_FIELDS.items() if dtype == 'int'}
+
+
+def file_hash(path: str):
+    '''
+    sha256 of the content of a file, read in blocks
+
+    :param path: (str) path to file
+    :return: (str) hex digest
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _axes(datasets: list):
+    # The union of the frequencies, categories and pelagic channels of the datasets
+    frequency = sorted({float(f) for ds in datasets for f in np.atleast_1d(ds['frequency'].values)})
+    category = sorted({int(c) for ds in datasets for c in ds['SaCategory'].values})
+
+    thickness = {float(np.nanmax(ds['pel_ch_thickness'].values)) for ds in datasets}
+    if len(thickness) > 1:
+        raise ValueError('The pelagic channel thickness differs between the reports: {}'.format(sorted(thickness)))
+    thickness = np.float32(thickness.pop())
+
+    # Channel numbers, the channel depths are computed as in report_xml2xarray
+    ch = np.concatenate([np.round(ds['ChannelDepthUpper'].values / thickness).astype(int) + 1 for ds in datasets])
+    channel_depth_lower = np.arange(np.min(ch), np.max(ch) + 1) * thickness
+    channel_depth_upper = channel_depth_lower - thickness
+
+    return frequency, category, channel_depth_upper, channel_depth_lower
+
+
+def _conform(ds: xr.Dataset, frequency: list, category: list, channel_depth_upper, channel_depth_lower):
+    # ds on the given axes, frequency None keeps the frequencies of ds.
+    # The sa that are not in ds are 0.0, as in the xml files,
+    # except for the distances that do not have the frequency, which are nan.
+    missing = ds['value'].isnull().all(['SaCategory', 'ChannelDepthUpper'])
+
+    ds = ds.reindex(SaCategory=category, ChannelDepthUpper=channel_depth_upper, fill_value={'value': 0.0})
+    ds['value'] = ds['value'].where(~missing)
+    ds = ds.assign_coords(ChannelDepthLower=('ChannelDepthUpper', channel_depth_lower))
+
+    return ds if frequency is None else ds.reindex(frequency=frequency, fill_value=FILL)
+
+
+def _merge(datasets: list):
+    # One time-sorted dataset, the last of duplicated distances is kept
+    axes = _axes(datasets)
+    ds = xr.concat([_conform(ds, *axes) for ds in datasets], dim='Time')
+    ds = ds.sortby('Time')
+    return ds.isel(Time=~ds.get_index('Time').duplicated(keep='last'))
+
+
+def read_report(path_xml: str):
+    '''
+    All frequencies of an LSSS report in one dataset with a frequency dimension.
+    Values of distances that do not have a frequency are nan, -1 for the integers.
+
+    :param path_xml: (str) path to xml file
+    :return: (xrarray.Dataset) xarray dataset
+    '''
+    datasets = list(report_xml2xarrays(path_xml, all_distances=True).values())
+    _, *axes = _axes(datasets)
+
+    # The frequencies share the distances, and so the per distance coordinates
+    return xr.concat([_conform(ds.expand_dims('frequency'), None, *axes) for ds in datasets], dim='frequency')
+
+
+def reports2zarr(paths: list, path_zarr: str, workers: int = None):
+    '''
+    Add LSSS reports to a zarr store, creating it if it does not exist.
+
+    :param paths: (list) paths to xml files
+    :param path_zarr: (str) path to the zarr store
+    :param workers: (int) processes parsing the files, default the number of cores
+    :return: (list) the paths that were added
+    '''
+    ingested = {}
+    if os.path.exists(path_zarr):
+        ingested = dict(zarr.open_group(path_zarr, mode='r').attrs.get('ingested_files', {}))
+
+    with ProcessPoolExecutor(workers) as pool:
+        hashes = list(pool.map(file_hash, paths))
+
+        # Skip the files already in the store, and copies of the same file
+        new = {}
+        for path, h in zip(paths, hashes):
+            if h not in ingested and h not in new:
+                new[h] = path
+        skipped = len(paths) - len(new)
+        if skipped:
+            print('{} files are already in {}, skipped'.format(skipped, path_zarr))
+        if not new:
+            return []
+
+        datasets = list(pool.map(read_report, new.values()))
+
+    ingested.update({h: os.path.basename(path) for h, path in new.items()})
+    ds = _merge(datasets)
+
+    if not os.path.exists(path_zarr):
+        mode = 'w'
+    else:
+        store = xr.open_zarr(path_zarr)
+        axes = _axes([store, ds])
+        same_axes = all(np.array_equal(a, store[dim].values) for a, dim in
+                        zip(axes[:3], ['frequency', 'SaCategory', 'ChannelDepthUpper']))
+        mode = 'a' if same_axes and ds['Time'].values[0] > store['Time'].values[-1] else 'w'
+        if mode == 'a':
+            ds = _conform(ds, *axes)
+        else:
+            # The new distances go before or in between, or the axes grow
+            ds = _merge([store.load(), ds])
+        store.close()
+
+    ds.attrs['ingested_files'] = ingested
+    if mode == 'a':
+        ds.to_zarr(path_zarr, mode='a', append_dim='Time')
+        zarr.open_group(path_zarr, mode='a').attrs['ingested_files'] = ingested
+    else:
+        ds.to_zarr(path_zarr, mode='w')
+    zarr.consolidate_metadata(path_zarr)
+
+    print('{} files added to {}, {}'.format(len(new), path_zarr, 'appended' if mode == 'a' else 'written'))
+    return list(new.values())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--src", type=str, help="Directory of LSSS reports")
+    parser.add_argument("--out", type=str, help="Zarr store, new reports are added to it if it exists")
+    parser.add_argument("--pattern", type=str, default='ListUserFile*.xml', help="File name pattern of the reports")
+    parser.add_argument("--workers", type=int, help="Processes parsing the reports, default the number of cores")
+    args = parser.parse_args()
+
+    reports2zarr(sorted(glob.glob(os.path.join(args.src, args.pattern))), args.out, args.workers)
@@ -4,130 +4,233 @@ import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
 
 
-def report_xml2xarray(path_xml: str, frequency: int):
-    '''
-    Convert LSSS report file from xml to xarray for a specified frequency.
+# Values per distance: name -> (xml attribute of distance, else child element, dtype)
+DISTANCE_FIELDS = {
+    'log_start': (True, 'float32'),
+    'start_time': (True, 'datetime64[ns]'),
+    'stop_time': (False, 'datetime64[ns]'),
+    'integrator_dist': (False, 'float32'),
+    'pel_ch_thickness': (False, 'float32'),
+    'include_estimate': (False, 'bool'),
+    'lat_start': (False, 'float32'),
+    'lat_stop': (False, 'float32'),
+    'lon_start': (False, 'float32'),
+    'lon_stop': (False, 'float32'),
+}
 
-    :param path_xml: (str) path to xml file
-    :param frequency: (int) selected frequency in Hz
-    :return: (xrarray.Dataset) xarray dataset
+# Values per distance and frequency: name -> dtype
+FREQUENCY_FIELDS = {
+    'threshold': 'float32',
+    'num_pel_ch': 'int',
+    'min_bot_depth': 'float32',
+    'max_bot_depth': 'float32',
+    'upper_interpret_depth': 'float32',
+    'lower_interpret_depth': 'float32',
+    'upper_integrator_depth': 'float32',
+    'lower_integrator_depth': 'float32',
+    'quality': 'int',
+    'bubble_corr': 'float32',
+}
+
+# Stored when a value is missing from a distance
+MISSING = {'float32': np.nan, 'datetime64[ns]': np.datetime64('NaT'), 'int': -1, 'bool': False}
+
+
+class _Column:
     '''
+    Preallocated array, doubled in size when it is full
+    '''
+    def __init__(self, dtype: str, size: int = 1024):
+        self.data = np.empty(size, dtype=dtype)
+        self.n = 0
 
-    # Note:
-    # Some xml files has specified URI namespaces, e.g. xmlns="http://www.imr.no/formats/nmdechosounder/v1".
-    # This prepend all tags on parsing, e.g. from 'distance' to '{http://www.imr.no/formats/nmdechosounder/v1}distance'.
-    # We therefore use {*}-expressions such as '{*}distance' in searching methods to ignore any specified URI namespaces.
-
-    def get_distance_values(root: ET.Element, variable: str, is_attrib: bool, dtype: str):
-        if is_attrib:
-            x = [distance.attrib[variable] for distance in root.find('{*}distance_list').findall('{*}distance')]
-        else:
-            x = [distance.find('{*}'+variable).text for distance in root.find('{*}distance_list').findall('{*}distance')]
-        return np.array(x, dtype=dtype)
-
-    def get_distance_frequency_values(root: ET.Element, variable: str, dtype: str):
-        x = [distance.find('{*}frequency[@freq=\"'+str(frequency)+'\"]').find('{*}'+variable).text for distance in
-             root.find('{*}distance_list').findall('{*}distance')]
-        return np.array(x, dtype=dtype)
-
-    tree = ET.parse(path_xml)
-    root = tree.getroot()
-
-    # Get list of the acoustic categories
-    category = sorted([int(acocat.attrib['acocat']) for acocat in root.find('{*}acocat_list').findall('{*}acocat')])
-
-    # Get data per distance
-    log_start = get_distance_values(root, 'log_start', True, 'float32')
-    start_time = get_distance_values(root, 'start_time', True, 'datetime64[ns]')
-    stop_time = get_distance_values(root, 'stop_time', False, 'datetime64[ns]')
-    integrator_dist = get_distance_values(root, 'integrator_dist', False, 'float32')
-    pel_ch_thickness = get_distance_values(root, 'pel_ch_thickness', False, 'float32')
-    include_estimate = get_distance_values(root, 'include_estimate', False, 'bool')
-    lat_start = get_distance_values(root, 'lat_start', False, 'float32')
-    lat_stop = get_distance_values(root, 'lat_stop', False, 'float32')
-    lon_start = get_distance_values(root, 'lon_start', False, 'float32')
-    lon_stop = get_distance_values(root, 'lon_stop', False, 'float32')
-    freq = np.float(frequency)
-    threshold = get_distance_frequency_values(root, 'threshold', 'float32')
-    num_pel_ch = get_distance_frequency_values(root, 'num_pel_ch', 'int')
-    min_bot_depth = get_distance_frequency_values(root, 'min_bot_depth', 'float32')
-    max_bot_depth = get_distance_frequency_values(root, 'max_bot_depth', 'float32')
-    upper_interpret_depth = get_distance_frequency_values(root, 'upper_interpret_depth', 'float32')
-    lower_interpret_depth = get_distance_frequency_values(root, 'lower_interpret_depth', 'float32')
-    upper_integrator_depth = get_distance_frequency_values(root, 'upper_integrator_depth', 'float32')
-    lower_integrator_depth = get_distance_frequency_values(root, 'lower_integrator_depth', 'float32')
-    quality = get_distance_frequency_values(root, 'quality', 'int')
-    bubble_corr = get_distance_frequency_values(root, 'bubble_corr', 'float32')
-
-    # Get the full range of pelagic channel numbers (lowest to highest record)
-    all_pel_ch = list()
-    for distance in root.find('{*}distance_list').findall('{*}distance'):
-        ch_type_p = distance.find('{*}frequency[@freq=\"'+str(frequency)+'\"]').find('{*}ch_type[@type="P"]')
-        if ch_type_p is not None:
-            for sa_by_acocat in ch_type_p.findall('{*}sa_by_acocat'):
-                for sa in sa_by_acocat.findall('{*}sa'):
-                    all_pel_ch.append(sa.attrib['ch'])
-    all_pel_ch = [int(ch) for ch in set(all_pel_ch)]
-    assert len(all_pel_ch) > 0
-    range_pel_ch = np.arange(np.min(all_pel_ch), np.max(all_pel_ch) + 1)
-
-    # Get the sa values per (distance, category, pelagic channel) - only use P (peleagic) values, discard B (bottom) values.
-    sa_values = []
-    for distance in root.find('{*}distance_list').findall('{*}distance'):
-        tmp = {cat: {ch: 0.0 for ch in range_pel_ch} for cat in category}
-        ch_type_p = distance.find('{*}frequency[@freq=\"'+str(frequency)+'\"]').find('{*}ch_type[@type="P"]')
-        if ch_type_p is not None:
-            # Todo: Should SaCategory be NaN or 0.0 if there is no record of <ch_type type="P"> in xml file?
-            # Todo (cont.): As per now: 0.0. I think this is right, because the xml file never report the zero-values.
-            for sa_by_acocat in ch_type_p.findall('{*}sa_by_acocat'):
-                for sa in sa_by_acocat.findall('{*}sa'):
-                    cat = int(sa_by_acocat.attrib['acocat'])
-                    ch = int(sa.attrib['ch'])
-                    tmp[cat][ch] = sa.text
-        # Convert tmp from dict to list (to avoid potential sorting issues)
-        tmp = [[tmp[cat][ch] for ch in range_pel_ch] for cat in category]
-        sa_values.append(tmp)
-    sa_values = np.array(sa_values, dtype='float32')
+    def append(self, value):
+        if self.n == len(self.data):
+            self.data = np.concatenate([self.data, np.empty_like(self.data)])
+        self.data[self.n] = value
+        self.n += 1
+
+    def values(self):
+        return self.data[:self.n]
+
+
+def _local(tag: str):
+    # Tag without the URI namespace, see the note in report_xml2xarray
+    return tag.rsplit('}', 1)[-1]
+
+
+def _value(element, dtype: str):
+    if element is None:
+        return MISSING[dtype]
+    text = element if isinstance(element, str) else element.text
+    if dtype == 'bool':
+        return text.strip().lower() in ['1', 'true']
+    if dtype.startswith('datetime64'):
+        # Times are UTC, numpy does not parse time zones
+        return text.strip().rstrip('Z')
+    return text
+
+
+def _frequency_columns():
+    columns = {name: _Column(dtype) for name, dtype in FREQUENCY_FIELDS.items()}
+    columns.update({'distance': _Column('int'), 'sa_distance': _Column('int'), 'sa_acocat': _Column('int'),
+                    'sa_ch': _Column('int'), 'sa': _Column('float32')})
+    return columns
+
+
+def _read_distance(distance: ET.Element, n: int, columns: dict, per_frequency: dict, frequencies):
+    children = {_local(child.tag): child for child in distance}
+    for name, (is_attrib, dtype) in DISTANCE_FIELDS.items():
+        columns[name].append(_value(distance.attrib.get(name) if is_attrib else children.get(name), dtype))
+
+    for frequency in distance:
+        if _local(frequency.tag) != 'frequency':
+            continue
+        freq = int(float(frequency.attrib['freq']))
+        if frequencies is not None and freq not in frequencies:
+            continue
+
+        f = per_frequency.setdefault(freq, _frequency_columns())
+        i = f['distance'].n
+        f['distance'].append(n)
+        fields = {_local(child.tag): child for child in frequency}
+        for name, dtype in FREQUENCY_FIELDS.items():
+            f[name].append(_value(fields.get(name), dtype))
+
+        # Only the P (pelagic) values, the B (bottom) values are discarded
+        for ch_type in frequency:
+            if _local(ch_type.tag) != 'ch_type' or ch_type.attrib.get('type') != 'P':
+                continue
+            for sa_by_acocat in ch_type:
+                cat = int(sa_by_acocat.attrib['acocat'])
+                for sa in sa_by_acocat:
+                    f['sa_distance'].append(i)
+                    f['sa_acocat'].append(cat)
+                    f['sa_ch'].append(int(sa.attrib['ch']))
+                    f['sa'].append(sa.text)
+
+
+def _frequency_dataset(columns: dict, f: dict, category: list, frequency: int, all_distances: bool = False):
+    if all_distances:
+        # The distances without the frequency get the missing values, and nan sa
+        n = columns['start_time'].n
+        idx = np.arange(n)
+        rows = f['distance'].values()
+        fields = {}
+        for name, dtype in FREQUENCY_FIELDS.items():
+            fields[name] = np.full(n, MISSING[dtype], dtype=dtype)
+            fields[name][rows] = f[name].values()
+    else:
+        idx = f['distance'].values()
+        rows = np.arange(len(idx))
+        fields = {name: f[name].values() for name in FREQUENCY_FIELDS}
+    distance = {name: column.values()[idx] for name, column in columns.items()}
+
+    # The full range of pelagic channel numbers (lowest to highest record)
+    sa_ch = f['sa_ch'].values()
+    assert len(sa_ch) > 0
+    range_pel_ch = np.arange(np.min(sa_ch), np.max(sa_ch) + 1)
+
+    # The xml file never reports the zero-values, the sa values not in the file are 0.0
+    sa_values = np.full((len(idx), len(category), len(range_pel_ch)), np.nan, dtype='float32')
+    sa_values[rows] = 0.0
+    acocat = f['sa_acocat'].values()
+    listed = np.isin(acocat, category)
+    sa_values[rows[f['sa_distance'].values()[listed]],
+              np.searchsorted(category, acocat[listed]),
+              sa_ch[listed] - range_pel_ch[0]] = f['sa'].values()[listed]
 
     # We check that pelagic channel thickness is constant. If not, the code breaks and must be written differently.
-    assert np.max(pel_ch_thickness) == np.min(pel_ch_thickness)
+    pel_ch_thickness = distance['pel_ch_thickness']
+    assert np.nanmax(pel_ch_thickness) == np.nanmin(pel_ch_thickness)
     channel_depth_lower = range_pel_ch * np.max(pel_ch_thickness)
     channel_depth_upper = channel_depth_lower - np.max(pel_ch_thickness)
     # Todo: Need to add transducer depth to get the correct channel depths?
 
     coords = dict(
         SaCategory=('SaCategory', category),
-        Time=('Time', start_time),
-        stop_time=('Time', stop_time),
+        Time=('Time', distance['start_time']),
+        stop_time=('Time', distance['stop_time']),
         ChannelDepthUpper=('ChannelDepthUpper', channel_depth_upper),
         ChannelDepthLower=('ChannelDepthUpper', channel_depth_lower),
-        Distance=('Time', log_start),
-        integrator_dist=('Time', integrator_dist),
+        Distance=('Time', distance['log_start']),
+        integrator_dist=('Time', distance['integrator_dist']),
         pel_ch_thickness=('Time', pel_ch_thickness),
-        include_estimate=('Time', include_estimate),
-        Latitude=('Time', lat_start),
-        Latitude2=('Time', lat_stop),
-        Longitude=('Time', lon_start),
-        Longitude2=('Time', lon_stop),
-        frequency=freq
+        include_estimate=('Time', distance['include_estimate']),
+        Latitude=('Time', distance['lat_start']),
+        Latitude2=('Time', distance['lat_stop']),
+        Longitude=('Time', distance['lon_start']),
+        Longitude2=('Time', distance['lon_stop']),
+        frequency=float(frequency)
     )
 
-    data_vars = dict(
-        value=(('Time', 'SaCategory', 'ChannelDepthUpper'), sa_values),
-        threshold=('Time', threshold),
-        num_pel_ch=('Time', num_pel_ch),
-        min_bot_depth=('Time', min_bot_depth),
-        max_bot_depth=('Time', max_bot_depth),
-        upper_interpret_depth=('Time', upper_interpret_depth),
-        lower_interpret_depth=('Time', lower_interpret_depth),
-        upper_integrator_depth=('Time', upper_integrator_depth),
-        lower_integrator_depth=('Time', lower_integrator_depth),
-        quality=('Time', quality),
-        bubble_corr=('Time', bubble_corr)
-    )
+    data_vars = dict(value=(('Time', 'SaCategory', 'ChannelDepthUpper'), sa_values))
+    data_vars.update({name: ('Time', fields[name]) for name in FREQUENCY_FIELDS})
     return xr.Dataset(data_vars=data_vars, coords=coords)
 
 
+def report_xml2xarrays(path_xml: str, frequencies=None, all_distances: bool = False):
+    '''
+    Convert LSSS report file from xml to xarray, for all frequencies in one pass over the file.
+
+    The file is read with iterparse, and each distance element is freed once its values
+    are copied to preallocated arrays, so the memory use follows the size of the values
+    and not of the xml tree.
+
+    :param path_xml: (str) path to xml file
+    :param frequencies: (list) frequencies in Hz to read, None reads all of them
+    :param all_distances: (bool) all datasets get all distances, the values of distances
+                          without the frequency are nan, -1 for the integers. Else a
+                          frequency only has the distances that report it.
+    :return: (dict) frequency in Hz -> xarray dataset, as report_xml2xarray
+    '''
+    category = []
+    columns = {name: _Column(dtype) for name, (_, dtype) in DISTANCE_FIELDS.items()}
+    per_frequency = {}
+    n = 0
+
+    parents = []
+    for event, elem in ET.iterparse(path_xml, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        parent = _local(parents[-1].tag) if parents else None
+
+        if tag == 'acocat' and parent == 'acocat_list':
+            category.append(int(elem.attrib['acocat']))
+        elif tag == 'distance' and parent == 'distance_list':
+            _read_distance(elem, n, columns, per_frequency, frequencies)
+            n += 1
+            # Free the distance, nothing else of it is needed
+            elem.clear()
+            parents[-1].remove(elem)
+
+    category = sorted(category)
+    return {freq: _frequency_dataset(columns, f, category, freq, all_distances) for freq, f in sorted(per_frequency.items())}
+
+
+def report_xml2xarray(path_xml: str, frequency: int):
+    '''
+    Convert LSSS report file from xml to xarray for a specified frequency.
+
+    :param path_xml: (str) path to xml file
+    :param frequency: (int) selected frequency in Hz
+    :return: (xrarray.Dataset) xarray dataset
+    '''
+
+    # Note:
+    # Some xml files has specified URI namespaces, e.g. xmlns="http://www.imr.no/formats/nmdechosounder/v1".
+    # This prepend all tags on parsing, e.g. from 'distance' to '{http://www.imr.no/formats/nmdechosounder/v1}distance'.
+    # We therefore compare the tags without the namespace, see _local.
+
+    ds = report_xml2xarrays(path_xml, [int(frequency)])
+    if int(frequency) not in ds:
+        raise ValueError('{} Hz is not in {}'.format(frequency, path_xml))
+    return ds[int(frequency)]
+
+
 if __name__ == '__main__':
 
     # test data
@@ -0,0 +1,209 @@
+import os
+import sys
+import json
+import dask
+import numpy as np
+import pandas as pd
+import xarray as xr
+from Logger import Logger as Log
+
+"""
+    Comparison of a generated report with an LSSS report
+
+    The reports are aligned on Time or Distance (the nearest LSSS log within a
+    tolerance), on ChannelDepthUpper and on SaCategory. The difference statistics
+    per category, per category and depth and per log are reduced from sums that
+    dask computes chunk by chunk in one pass, so the reports are never loaded
+    whole and a survey is compared in seconds.
+
+    Both reports are compared as Sa in m2nmi-2 per channel. The generated report
+    stores the mean sv of a cell, which is converted as in Reportgenerator.saveReport.
+
+    python Compare.py --report S_report.zarr --lsss ListUserFile20.xml --out S_compare.json
+                      --max_rel_diff 0.05 --min_corr 0.95
+    exits with status 1 when a category is outside the limits, as a regression gate.
+"""
+
+def loadLSSS(fname, frequency=38000):
+    """
+    An LSSS report as a dataset with value in m2nmi-2:
+    .xml is converted with fileconverter/xml2zarr.py, a .zarr store from lsss2zarr.py
+    or xml2zarr.py is opened, and frequency selected when it has a frequency dimension
+    """
+    if os.path.splitext(fname)[1].lower() == '.xml':
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fileconverter'))
+        from xml2zarr import report_xml2xarray
+        return report_xml2xarray(fname, frequency)
+
+    lsss = xr.open_zarr(fname)
+    if 'frequency' in lsss.dims:
+        lsss = lsss.sel(frequency=float(frequency))
+    return lsss
+
+
+def toSa(report):
+    """
+    value of a generated report in m2nmi-2, as written by saveReport
+    """
+    thickness = float(np.median(np.diff(report['ChannelDepthUpper'].values)))
+    return report['value'] * 4 * np.pi * 1852**2 * thickness
+
+
+def _nearest(source, target, tolerance):
+    # Position in the sorted, unique source of the nearest value to each target, -1 if further than tolerance
+    index = pd.Index(source)
+    return index.get_indexer(target, method='nearest', tolerance=tolerance)
+
+
+def align(report, lsss, on='Time', tolerance=None):
+    """
+    The Sa of report and lsss on the cells they share, as two DataArrays
+    (SaCategory, Time, ChannelDepthUpper) on the Time of report and chunked as report.
+    on        : 'Time' or 'Distance', the coordinate the logs are matched on
+    tolerance : largest distance to the nearest LSSS log, a timedelta for Time and nmi for
+                Distance. By default half the median step between the LSSS logs
+    """
+    if on not in ['Time', 'Distance']:
+        raise ValueError('{} alignment not defined'.format(on))
+
+    lsss = lsss.sortby(on)
+    keys = lsss[on].values
+    keep = ~pd.Index(keys).duplicated(keep='last')
+    lsss, keys = lsss.isel(Time=keep), keys[keep]
+    if tolerance is None:
+        tolerance = np.median(np.diff(keys)) / 2
+    elif on == 'Time':
+        tolerance = pd.Timedelta(tolerance)
+
+    logs = _nearest(keys, report[on].values, tolerance)
+    depths = _nearest(lsss['ChannelDepthUpper'].values, report['ChannelDepthUpper'].values,
+                      float(np.median(np.diff(report['ChannelDepthUpper'].values))) / 100)
+    categories = np.intersect1d(report['SaCategory'].values, lsss['SaCategory'].values)
+    if not (logs >= 0).any() or not (depths >= 0).any() or len(categories) == 0:
+        raise ValueError('The reports have no cells in common')
+
+    x = toSa(report).isel(Time=np.flatnonzero(logs >= 0), ChannelDepthUpper=np.flatnonzero(depths >= 0))
+    x = x.sel(SaCategory=categories).transpose('SaCategory', 'Time', 'ChannelDepthUpper')
+
+    # Lazy, the LSSS logs are only repeated onto the report bins chunk by chunk
+    y = lsss['value'].chunk().isel(Time=logs[logs >= 0], ChannelDepthUpper=depths[depths >= 0])
+    y = y.sel(SaCategory=categories).transpose('SaCategory', 'Time', 'ChannelDepthUpper')
+    y = xr.DataArray(y.data, dims=x.dims, coords={k: x[k] for k in x.dims})
+    if x.chunks is not None:
+        y = y.chunk(dict(zip(x.dims, x.chunks)))
+
+    Log().info('{} of {} Time bins, {} channels and {} categories in common with the LSSS report'.format(
+        x.sizes['Time'], report.sizes['Time'], x.sizes['ChannelDepthUpper'], len(categories)))
+    return x, y
+
+
+def _sums(x, y, dims):
+    # The sums of the cells with both values, reduced over dims
+    valid = x.notnull() & y.notnull()
+    x = x.where(valid, 0).astype('float64')
+    y = y.where(valid, 0).astype('float64')
+    d = x - y
+    terms = {'n': valid, 'x': x, 'y': y, 'd': d, 'ad': abs(d), 'dd': d * d, 'xx': x * x, 'yy': y * y, 'xy': x * y}
+    return xr.Dataset({k: v.sum(dims) for k, v in terms.items()}).reset_coords(drop=True)
+
+
+def _statistics(s):
+    # Difference statistics from the sums, x is the report and y LSSS
+    n = s['n'].where(s['n'] > 0)
+    cov = n * s['xy'] - s['x'] * s['y']
+    var = (n * s['xx'] - s['x']**2) * (n * s['yy'] - s['y']**2)
+    return xr.Dataset({
+        'cells': s['n'],
+        'sa_report': s['x'],
+        'sa_lsss': s['y'],
+        'bias': s['d'] / n,
+        'mae': s['ad'] / n,
+        'rmse': np.sqrt(s['dd'] / n),
+        'rel_diff': (s['x'] - s['y']) / s['y'].where(s['y'] != 0),
+        'corr': cov / np.sqrt(var.where(var > 0)),
+    })
+
+
+def compare(report, lsss, on='Time', tolerance=None):
+    """
+    Difference statistics between the Sa of report and lsss, computed in one pass:
+    per category, per category and ChannelDepthUpper, and per category and log (Time bin)
+    with Sa summed over the channels. Sums are over the cells where both have a value.
+    :return: (dict) 'category', 'depth', 'log' -> xarray.Dataset of the statistics
+    """
+    x, y = align(report, lsss, on, tolerance)
+
+    per_log = xr.Dataset({'sa_report': x.where(y.notnull()).sum('ChannelDepthUpper'),
+                          'sa_lsss': y.where(x.notnull()).sum('ChannelDepthUpper')})
+    sums = dask.compute(_sums(x, y, ['Time', 'ChannelDepthUpper']), _sums(x, y, ['Time']), per_log)
+
+    per_log = sums[2].reset_coords(drop=True)
+    per_log = per_log.assign(diff=per_log['sa_report'] - per_log['sa_lsss'])
+    per_log = per_log.assign_coords(Distance=('Time', x['Distance'].values)) if 'Distance' in x.coords else per_log
+    return {'category': _statistics(sums[0]), 'depth': _statistics(sums[1]), 'log': per_log}
+
+
+def check(summary, max_rel_diff=None, min_corr=None):
+    """
+    The categories outside the limits, as messages. Empty when the comparison passes.
+    """
+    failed = []
+    for cat in summary['category']['SaCategory'].values:
+        s = summary['category'].sel(SaCategory=cat)
+        if max_rel_diff is not None and not abs(float(s['rel_diff'])) <= max_rel_diff:
+            failed.append('SaCategory {}: relative difference {:.4g} above {}'.format(cat, float(s['rel_diff']), max_rel_diff))
+        if min_corr is not None and not float(s['corr']) >= min_corr:
+            failed.append('SaCategory {}: correlation {:.4g} below {}'.format(cat, float(s['corr']), min_corr))
+    return failed
+
+
+def _records(stats, dims):
+    df = stats.to_dataframe().reset_index()
+    return json.loads(df[list(dims) + list(stats.data_vars)].to_json(orient='records', date_format='iso'))
+
+
+def writeSummary(summary, fname, worst=10, logs=False):
+    """
+    The statistics per category and per depth as json, with the worst logs, those with
+    the largest absolute difference of Sa. logs writes all logs to fname with a _logs.csv ending
+    """
+    per_log = summary['log']
+    diff = abs(per_log['diff']).max('SaCategory').values
+    worst_logs = per_log.isel(Time=np.argsort(-np.nan_to_num(diff))[:worst])
+
+    out = {'category': _records(summary['category'], ['SaCategory']),
+           'depth': _records(summary['depth'], ['SaCategory', 'ChannelDepthUpper']),
+           'worst_logs': _records(worst_logs.drop_vars('Distance', errors='ignore'), ['SaCategory', 'Time'])}
+    with open(fname, 'w') as f:
+        json.dump(out, f, indent=1)
+
+    if logs:
+        per_log.to_dataframe().to_csv(os.path.splitext(fname)[0] + '_logs.csv')
+    Log().info(f'Comparison summary written to : {fname}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare a generated report with an LSSS report')
+    parser.add_argument("--report", type=str, help="Generated report (zarr)")
+    parser.add_argument("--lsss", type=str, help="LSSS report (ListUserFile xml, or zarr from fileconverter)")
+    parser.add_argument("--out", type=str, help="Summary file (json)")
+    parser.add_argument("--freq", type=float, default=38000, help="Frequency of the LSSS report")
+    parser.add_argument("--on", type=str, choices=['Time', 'Distance'], default='Time', help="Match the logs on Time or Distance")
+    parser.add_argument("--tolerance", type=str, help="Largest distance to the LSSS log, e.g. 30s, or nmi with --on Distance")
+    parser.add_argument("--logs", type=int, choices=[0, 1], default=0, help="Also write the statistics of all logs to csv")
+    parser.add_argument("--max_rel_diff", type=float, help="Fail when the total Sa of a category differs more than this")
+    parser.add_argument("--min_corr", type=float, help="Fail when the correlation of the cells of a category is below this")
+    args = parser.parse_args()
+
+    tolerance = float(args.tolerance) if args.tolerance is not None and args.on == 'Distance' else args.tolerance
+    summary = compare(xr.open_zarr(args.report), loadLSSS(args.lsss, args.freq), args.on, tolerance)
+    if args.out is not None:
+        writeSummary(summary, args.out, logs=bool(args.logs))
+
+    print(summary['category'].to_dataframe().to_string())
+    failed = check(summary, args.max_rel_diff, args.min_corr)
+    for message in failed:
+        Log().error(message)
+    sys.exit(1 if failed else 0)
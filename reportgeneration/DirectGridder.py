@@ -0,0 +1,105 @@
+import numpy as np
+from NPGridder import NPGridder, GridType
+
+"""
+    Lossless griding in one pass over the pings on numpy arrays
+    The source pings are gridded a batch at a time: the batch is integrated
+    vertically and added into the target pings it overlaps. Only a batch of
+    pings x target range is held, not the pings x target range intermediate
+    of W·data for all pings, at about the speed of the two matmuls.
+"""
+
+# Max number of source samples gridded per batch, bounds the temporary arrays
+BATCH_SIZE = 2 ** 22
+
+
+def directIntegrate(Wh, Wv, data):
+    """
+    Input :
+        Wh   - Horizontal weights, CSR (target pings x source pings), without the edge column
+        Wv   - Vertical weights, CSR (target range x source range), without the edge column
+        data - Source samples (pings, ..., range)
+
+    Returns out[t, ..., v] = sum over p, r of Wh[t, p] * Wv[v, r] * data[p, ..., r]
+
+    Wv is applied once to each batch of source pings, and the batch is scattered
+    into the output along the pings only, with the columns of Wh of the batch.
+    The memory use is set by BATCH_SIZE instead of the number of pings, for
+    about the time of NPGridder.
+    """
+    Wh = Wh.tocsc()
+    nt, nv, nr = Wh.shape[0], Wv.shape[0], data.shape[-1]
+    mid = data.shape[1:-1]
+    m = int(np.prod(mid))
+    data = data.reshape(data.shape[0], m * nr)
+
+    out = np.zeros((nt, m * nv))
+    step = max(1, BATCH_SIZE // max(1, m * nr))
+    for p in range(0, data.shape[0], step):
+        block = data[p:p + step]
+
+        # (pings x ..., range) -> (pings, ... x target range)
+        vertical = Wv.dot(block.reshape(-1, nr).T).T.reshape(block.shape[0], m * nv)
+        out += Wh[:, p:p + step].dot(vertical)
+
+    return out.reshape((nt,) + mid + (nv,))
+
+
+class DirectGridder(NPGridder):
+    # target_v_bins, source_v_bins, target_h_bins, source_h_bins
+    def __init__(self, target_v_bins=None, source_v_bins=None, target_h_bins=None, source_h_bins=None):
+        super().__init__(target_v_bins, source_v_bins, target_h_bins, source_h_bins)
+
+    def regrid(self, data):
+
+        if self.griddType == GridType.OneDimension:
+            # Nothing to fuse in one dimension
+            return super().regrid(data)
+
+        elif self.griddType == GridType.TwoDimension:
+            Wv, edge_v = self._splitWeight(self._weight(self.target_v_bins, self.source_v_bins))
+            Wh, edge_h = self._splitWeight(self._weight(self.target_h_bins, self.source_h_bins))
+
+            gridded = directIntegrate(Wh, Wv, data)
+            gridded[edge_h] = np.nan
+            gridded[..., edge_v] = np.nan
+
+            return gridded
+
+
+if __name__ == "__main__":
+
+    import matplotlib.pyplot as plt
+
+    noBootstraps = 100
+    n_pings = 1000
+    maxRange = 100
+
+    ratio = []
+    for i in range(0, noBootstraps):
+
+        # generate data
+        sampleRange = np.arange(0, maxRange, 0.18)
+        samplePings = np.arange(0, n_pings, 1)
+        sv_s = (np.random.random((n_pings, len(sampleRange))) * 100000).astype(float)
+        downSampleRange = np.arange(0, maxRange, np.random.uniform(0.1, 10))
+        downSamplePing = np.arange(0, n_pings, np.random.uniform(0.5, 50))
+
+        direct = DirectGridder(downSampleRange, sampleRange, downSamplePing, samplePings).regrid(sv_s)
+        matmul = NPGridder(downSampleRange, sampleRange, downSamplePing, samplePings).regrid(sv_s)
+
+        # Energy in the inner bins, the same cells as the two matmuls
+        inner = np.isfinite(matmul)
+        assert np.array_equal(inner, np.isfinite(direct))
+        assert np.allclose(direct[inner], matmul[inner])
+
+        ratio.append(direct[inner].sum() / matmul[inner].sum())
+
+    print('max |1 - ratio| {}'.format(np.max(np.abs(1 - np.array(ratio)))))
+
+    plt.figure()
+    plt.hist(ratio, bins=200)
+    plt.title('DirectGridder / NPGridder, N={}'.format(len(ratio)))
+    plt.xlabel('Ratio')
+    plt.ylabel('Count')
+    plt.show()
@@ -1,160 +1,245 @@
 import os
 import shutil
+import argparse
 import xarray as xr
 import zarr
 import datetime
+from contextlib import nullcontext
 # import sys
 # os.chdir('/home/nilsolav/repos/CRIMAC-reportgeneration')
 # sys.path.append('/home/nilsolav/repos/CRIMAC-reportgeneration/reportgeneration')
 import reportgeneration.Reportgenerator as rg
 from Logger import Logger as Log
-
-Log().info('####### Setting up #######')
-commit_sha = os.getenv('COMMIT_SHA', 'NaN')
-
-# Set and check file directories
-dirs = ['/datain/', '/predin/', '/dataout/']
-
-datain, predin, dataout = dirs
-for d in dirs:
-    _dir = os.path.expanduser(d)
-    if not os.path.exists(_dir):
-        Log().error('####### {} could not be found #######'.format(_dir))
-
-# Generate the file references
-grid_file_name = datain+os.getenv('SURVEY')+'_sv.zarr'
-pred_file_name = predin+os.getenv('PREDICTIONFILE')
-bot_file_name = datain+os.getenv('SURVEY')+'_bottom.zarr'
-report_file_name = dataout+os.getenv('REPORTFILE')
-
-# d = '/mnt/c/DATAscratch/crimac-scratch/2007/S2007205/ACOUSTIC/'
-# grid_file_name = d+'GRIDDED/S2007205_sv.zarr'
-# pred_file_name = d+'GRIDDED/S2007205_labels.zarr'
-# bot_file_name = d+'GRIDDED/S2007205_bottom.zarr'
-# report_file_name = d+'REPORTS/S2007205_report_1.zarr'
-
-# Check if input files exist
-files = [grid_file_name, pred_file_name, bot_file_name]
-for d in files:
-    _dir = os.path.expanduser(d)
-    if not os.path.exists(_dir):
-        print('{} could not be found.'.format(_dir))
+from WeightCache import WeightCache
+from Scheduler import Scheduler, addSchedulerArguments
+from Follower import Follower
+from ReportWriter import writeCSV
+from Pyramid import pyramidName
+from Metrics import Instrument
+from Progress import ProgressReporter
+
+if __name__ == "__main__":
+
+    Log().info('####### Setting up #######')
+    commit_sha = os.getenv('COMMIT_SHA', 'NaN')
+
+    # Set and check file directories
+    dirs = ['/datain/', '/predin/', '/dataout/']
+
+    datain, predin, dataout = dirs
+    for d in dirs:
+        _dir = os.path.expanduser(d)
+        if not os.path.exists(_dir):
+            Log().error('####### {} could not be found #######'.format(_dir))
+
+    # Generate the file references
+    grid_file_name = datain+os.getenv('SURVEY')+'_sv.zarr'
+    pred_file_name = predin+os.getenv('PREDICTIONFILE')
+    bot_file_name = datain+os.getenv('SURVEY')+'_bottom.zarr'
+    report_file_name = dataout+os.getenv('REPORTFILE')
+
+    # d = '/mnt/c/DATAscratch/crimac-scratch/2007/S2007205/ACOUSTIC/'
+    # grid_file_name = d+'GRIDDED/S2007205_sv.zarr'
+    # pred_file_name = d+'GRIDDED/S2007205_labels.zarr'
+    # bot_file_name = d+'GRIDDED/S2007205_bottom.zarr'
+    # report_file_name = d+'REPORTS/S2007205_report_1.zarr'
+
+    # Check if input files exist
+    files = [grid_file_name, pred_file_name, bot_file_name]
+    for d in files:
+        _dir = os.path.expanduser(d)
+        if not os.path.exists(_dir):
+            print('{} could not be found.'.format(_dir))
+        else:
+            print('{} is available.'.format(_dir))        
+    print('{} is set as report file name.'.format(report_file_name))
+
+    # Dask scheduler, flags override the env vars
+    parser = argparse.ArgumentParser()
+    addSchedulerArguments(parser, spill_dir=dataout + 'dask-spill')
+    args, _ = parser.parse_known_args()
+
+    # Keep gridding new pings as the survey data grows
+    follow = os.getenv('FOLLOW', '0') == '1'
+    PollInterval = float(os.getenv('POLL_INTERVAL', 60))
+    Latency = float(os.getenv('LATENCY', 300))
+    IdleTimeout = float(os.getenv('IDLE_TIMEOUT', 0)) or None
+
+    # Delete old report, unless new pings are appended to it
+    append = os.getenv('APPEND', '0') == '1' or follow
+    if os.path.exists(report_file_name) and not append:
+        Log().info('####### Old report exist: deleting #######')
+        shutil.rmtree(report_file_name)
+        shutil.rmtree(pyramidName(report_file_name), ignore_errors=True)
+
+    print(' ')
+    Log().info('####### Setting up env variables #######')
+
+    # Env vars
+    PingAxisIntervalType = os.getenv('PING_AXIS_INTERVAL_TYPE', 'distance')
+    PingAxisIntervalOrigin = os.getenv('PING_AXIS_INTERVAL_ORIGIN', 'start')
+    PingAxisIntervalUnit = os.getenv('PING_AXIS_INTERVAL_UNIT', 'nmi')
+    PingAxisInterval = float(os.getenv('PING_AXIS_INTERVAL', 0.1))
+
+    # Channel
+    ChannelDepthStart = float(os.getenv('CHANNEL_DEPTH_START', 0))
+    ChannelDepthEnd = float(os.getenv('CHANNEL_DEPTH_END', 500))
+    ChannelThickness = float(os.getenv('CHANNEL_THICKNESS', 5))
+    ChannelType = os.getenv('CHANNEL_TYPE', 'depth')
+
+    # Values
+    SvThreshold = float(os.getenv('SV_THRESHOLD', -100))
+    Type = os.getenv('TYPE', 'C')
+    Unit = os.getenv('UNIT', 'm2nmi-2')
+    main_freq = int(os.getenv('MAIN_FREQ', 38000))
+    output_type = os.getenv('OUTPUT_TYPE', 'zarr')
+    classthreshold = float(os.getenv('CLASSTRHRESHOLD', 0.8))
+    fused = os.getenv('FUSED', '1') == '1'
+    engine = os.getenv('GRID_ENGINE', 'matmul')
+    # Time bins gridded and written at a time, 0 grids the whole survey at once
+    window = int(os.getenv('WINDOW_SIZE', 0)) or None
+    # Parquet dataset next to the csv, partitioned by category and optionally by day
+    parquet = os.getenv('PARQUET', '0') == '1'
+    ParquetByDay = os.getenv('PARQUET_BY_DAY', '0') == '1'
+    ParquetDropZeros = os.getenv('PARQUET_DROP_ZEROS', '0') == '1'
+    # ICES Acoustic xml next to the csv
+    IcesXml = os.getenv('ICES_XML', '0') == '1'
+    # Encoding of the report store: default | archive | fast-write | fast-read
+    profile = os.getenv('ENCODING_PROFILE', 'default')
+    # Multiscale pyramid next to the report
+    pyramid = os.getenv('PYRAMID', '0') == '1'
+    # cProfile output and dask performance report next to the run metrics
+    cprofile = os.getenv('CPROFILE', '0') == '1'
+    DaskReport = os.getenv('DASK_REPORT', '0') == '1'
+    # Seconds between the progress reports in the log, 0 for none, and a json file with the progress
+    ProgressInterval = float(os.getenv('PROGRESS_INTERVAL', 60))
+    ProgressFile = os.getenv('PROGRESS_FILE', None)
+
+    # Weight cache, reused between runs with the same bins
+    WeightCacheDir = os.getenv('WEIGHT_CACHE_DIR', None)
+    WeightCacheSize = float(os.getenv('WEIGHT_CACHE_SIZE', 10240))  # MB
+    if WeightCacheDir is not None:
+        WeightCache().setDiskDir(WeightCacheDir)
+        WeightCache().setMaxDiskSize(WeightCacheSize * 1024**2)
+
+    # Print env vars
+    v = [PingAxisIntervalType, PingAxisIntervalOrigin, PingAxisIntervalUnit,
+         PingAxisInterval, ChannelDepthStart, ChannelDepthEnd, ChannelThickness,
+         ChannelType, SvThreshold, Type, Unit, main_freq, output_type, classthreshold,
+         fused, engine, window, profile, pyramid, parquet, IcesXml, follow, WeightCacheDir, WeightCacheSize,
+         cprofile, DaskReport, ProgressInterval, ProgressFile]
+    vt = ['PingAxisIntervalType', 'PingAxisIntervalOrigin', 'PingAxisIntervalUnit',
+          'PingAxisInterval', 'ChannelDepthStart', 'ChannelDepthEnd', 'ChannelThickness',
+          'ChannelType', 'SvThreshold', 'Type', 'Unit', 'main_freq', 'output_type', 'classthreshold',
+          'fused', 'engine', 'window', 'profile', 'pyramid', 'parquet', 'IcesXml', 'follow', 'WeightCacheDir', 'WeightCacheSize',
+          'cprofile', 'DaskReport', 'ProgressInterval', 'ProgressFile']
+    for i, _v in enumerate(v):
+        print(vt[i]+': '+str(v[i])+' '+str(type(_v)))
+    print(' ')
+
+    Log().info('####### Check zarr file input size #######')
+
+    grid = xr.open_zarr(grid_file_name)
+    pred = xr.open_zarr(pred_file_name)
+    Log().info('####### Check _sv.zarr input size #######')
+    print(grid.dims)
+    Log().info('####### Check _pred.zarr input size #######')
+    print(pred.dims)
+    if bot_file_name is None:
+        zarr_bot = None
     else:
-        print('{} is available.'.format(_dir))        
-print('{} is set as report file name.'.format(report_file_name))
-
-# Delete old report
-if os.path.exists(report_file_name):
-    Log().info('####### Old report exist: deleting #######')
-    shutil.rmtree(report_file_name)
-
-print(' ')
-Log().info('####### Setting up env variables #######')
-
-# Env vars
-PingAxisIntervalType = os.getenv('PING_AXIS_INTERVAL_TYPE', 'distance')
-PingAxisIntervalOrigin = os.getenv('PING_AXIS_INTERVAL_ORIGIN', 'start')
-PingAxisIntervalUnit = os.getenv('PING_AXIS_INTERVAL_UNIT', 'nmi')
-PingAxisInterval = float(os.getenv('PING_AXIS_INTERVAL', 0.1))
-
-# Channel
-ChannelDepthStart = float(os.getenv('CHANNEL_DEPTH_START', 0))
-ChannelDepthEnd = float(os.getenv('CHANNEL_DEPTH_END', 500))
-ChannelThickness = float(os.getenv('CHANNEL_THICKNESS', 5))
-ChannelType = os.getenv('CHANNEL_TYPE', 'depth')
-
-# Values
-SvThreshold = float(os.getenv('SV_THRESHOLD', -100))
-Type = os.getenv('TYPE', 'C')
-Unit = os.getenv('UNIT', 'm2nmi-2')
-main_freq = int(os.getenv('MAIN_FREQ', 38000))
-output_type = os.getenv('OUTPUT_TYPE', 'zarr')
-classthreshold = float(os.getenv('CLASSTRHRESHOLD', 0.8))
-
-# Print env vars
-v = [PingAxisIntervalType, PingAxisIntervalOrigin, PingAxisIntervalUnit,
-     PingAxisInterval, ChannelDepthStart, ChannelDepthEnd, ChannelThickness,
-     ChannelType, SvThreshold, Type, Unit, main_freq, output_type, classthreshold]
-vt = ['PingAxisIntervalType', 'PingAxisIntervalOrigin', 'PingAxisIntervalUnit',
-      'PingAxisInterval', 'ChannelDepthStart', 'ChannelDepthEnd', 'ChannelThickness',
-      'ChannelType', 'SvThreshold', 'Type', 'Unit', 'main_freq', 'output_type', 'classthreshold']
-for i, _v in enumerate(v):
-    print(vt[i]+': '+str(v[i])+' '+str(type(_v)))
-print(' ')
-
-Log().info('####### Check zarr file input size #######')
-
-grid = xr.open_zarr(grid_file_name)
-pred = xr.open_zarr(pred_file_name)
-Log().info('####### Check _sv.zarr input size #######')
-print(grid.dims)
-Log().info('####### Check _pred.zarr input size #######')
-print(pred.dims)
-if bot_file_name is None:
-    zarr_bot = None
-else:
-    zarr_bot = xr.open_zarr(bot_file_name)
-    Log().info('####### Check _bot.zarr input size #######')
-    print(zarr_bot.dims)
-
-#
-# Do the regridding
-#
-with rg.Reportgenerator(grid_file_name,
-                        pred_file_name,
-                        bot_file_name,
-                        report_file_name,
-                        main_freq,
-                        SvThreshold,
-                        ChannelType,
-                        ChannelThickness,
-                        PingAxisIntervalOrigin,
-                        PingAxisIntervalUnit,
-                        PingAxisInterval,
-                        ChannelDepthStart,
-                        ChannelDepthEnd) as rep:
-    
-    rep.saveGridd(report_file_name)
-    rep.saveImages(report_file_name+'.png')
-    rep.saveReport(report_file_name+'.csv')
-
-# Consolidating metadata
-zarr.consolidate_metadata(report_file_name)
-
-#
-# Saving to ICESAcoustic format
-#
-
-# Reading the report & original data
-report = xr.open_zarr(report_file_name)
-
-# Add provenance information
-
-report = report.assign_attrs({
-    "conversion_software_version": commit_sha,
-    "conversion_software_name": "https://github.com/CRIMAC-WP4-Machine-learning/CRIMAC-reportgeneration (dockerized version)",
-    "conversion_time": datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()})
-
-if bot_file_name is None:
-    report = report.assign_attrs({
-        "source_filenames_sv": grid_file_name,
-        "source_filenames_labels": pred_file_name})
-else:
-    zarr_bot = xr.open_zarr(bot_file_name)
-    report = report.assign_attrs({
-        "source_filenames_sv": grid_file_name,
-        "source_filenames_labels": pred_file_name,
-        "source_filenames_bottom": bot_file_name})
-
-#
-# Flatten the data to a dataframe and write to file
-#
-
-df = report.to_dataframe()
-# Add the attributes to the df
-for item in list(report.attrs.items()):
-    df[item[0]] = item[1]
-# Save report to pandas tidy file
-df.to_csv(report_file_name+'.csv', index=True)
-
-# That's it
+        zarr_bot = xr.open_zarr(bot_file_name)
+        Log().info('####### Check _bot.zarr input size #######')
+        print(zarr_bot.dims)
+
+    #
+    # Do the regridding
+    #
+    # All computations run on the configured scheduler. The run metrics are written
+    # next to the report, when following for each update, see Follower.update
+    instrument = nullcontext() if follow else Instrument(report_file_name, cprofile, DaskReport)
+    progress = ProgressReporter(ProgressInterval, ProgressFile) if ProgressInterval > 0 else nullcontext()
+    with Scheduler.fromArgs(args), progress, instrument:
+        if follow:
+            Follower(grid_file_name, pred_file_name, bot_file_name, report_file_name,
+                     PollInterval, Latency, IdleTimeout,
+                     freq=main_freq,
+                     SvThreshold=SvThreshold,
+                     vtype=ChannelType,
+                     vstep=ChannelThickness,
+                     PingAxisIntervalOrigin=PingAxisIntervalOrigin,
+                     htype=PingAxisIntervalUnit,
+                     hstep=PingAxisInterval,
+                     ChannelDepthStart=ChannelDepthStart,
+                     ChannelDepthEnd=ChannelDepthEnd,
+                     commit_sha=commit_sha,
+                     fused=fused,
+                     engine=engine,
+                     window=window,
+                     profile=profile,
+                     pyramid=pyramid).run()
+        else:
+            with rg.Reportgenerator(grid_file_name,
+                                    pred_file_name,
+                                    bot_file_name,
+                                    report_file_name,
+                                    main_freq,
+                                    SvThreshold,
+                                    ChannelType,
+                                    ChannelThickness,
+                                    PingAxisIntervalOrigin,
+                                    PingAxisIntervalUnit,
+                                    PingAxisInterval,
+                                    ChannelDepthStart,
+                                    ChannelDepthEnd,
+                                    commit_sha,
+                                    fused,
+                                    engine,
+                                    window,
+                                    profile=profile,
+                                    pyramid=pyramid) as rep:
+
+                rep.saveGridd(report_file_name)
+                rep.saveImages(report_file_name+'.png')
+                rep.saveReport(report_file_name+'.csv')
+                if parquet:
+                    rep.saveReport(report_file_name+'.parquet', by_day=ParquetByDay, drop_zeros=ParquetDropZeros)
+                if IcesXml:
+                    rep.saveReport(report_file_name+'.xml')
+
+        # Consolidating metadata
+        zarr.consolidate_metadata(report_file_name)
+
+        #
+        # Saving to ICESAcoustic format
+        #
+
+        # Reading the report & original data
+        report = xr.open_zarr(report_file_name)
+
+        # Add provenance information
+
+        report = report.assign_attrs({
+            "conversion_software_version": commit_sha,
+            "conversion_software_name": "https://github.com/CRIMAC-WP4-Machine-learning/CRIMAC-reportgeneration (dockerized version)",
+            "conversion_time": datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()})
+
+        if bot_file_name is None:
+            report = report.assign_attrs({
+                "source_filenames_sv": grid_file_name,
+                "source_filenames_labels": pred_file_name})
+        else:
+            zarr_bot = xr.open_zarr(bot_file_name)
+            report = report.assign_attrs({
+                "source_filenames_sv": grid_file_name,
+                "source_filenames_labels": pred_file_name,
+                "source_filenames_bottom": bot_file_name})
+
+        #
+        # Flatten the data to a dataframe and write to file
+        #
+
+        # Save report to pandas tidy file, a block of Time bins at a time, with the attributes in a json sidecar
+        writeCSV(report, report_file_name+'.csv')
+
+        # That's it
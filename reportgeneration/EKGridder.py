@@ -2,6 +2,7 @@ import numpy as np
 import xarray as xr
 import dask
 from Logger import Logger as Log
+from Metrics import measure
 from reportgeneration.XGridder import XGridder
 
 
@@ -9,15 +10,29 @@ from reportgeneration.XGridder import XGridder
     Lossless gridding on EKdata from gridder    
 """
 class EKGridder(XGridder):
-    def __init__(self, data, v_integration_type='range', v_step=50,PingAxisIntervalOrigin='start', h_integration_type='ping', h_step=10, ChannelDepthStart=0, ChannelDepthEnd=500):
+    @measure('gridder')
+    def __init__(self, data, v_integration_type='range', v_step=50,PingAxisIntervalOrigin='start', h_integration_type='ping', h_step=10, ChannelDepthStart=0, ChannelDepthEnd=500, engine='matmul', origin=None):
+        """
+        origin : Where the horizontal grid starts, when data is the tail of a survey that is already gridded up to origin['bin'].
+                 bin      - first target bin to make
+                 ping     - index of the first ping of data in the survey
+                 time     - ping_time of the first ping of the survey
+                 distance - distance of the first ping of the survey
+                 None grids data as a whole survey.
+        """
         self.ping_time = None
         self.distance = None
         self.PingAxisIntervalOrigin = PingAxisIntervalOrigin
         data = data.sel(range=slice(ChannelDepthStart, ChannelDepthEnd))
 
+        if origin is None:
+            origin = {'bin': 0, 'ping': 0, 'time': data['ping_time'].values[0],
+                      'distance': float(data['distance'][0]) if 'distance' in data else np.nan}
+        self.origin = origin
+
         source_v_bins, target_v_bins = self.calckBins(data, v_integration_type, v_step, ChannelDepthStart, ChannelDepthEnd)
         source_h_bins, target_h_bins = self.calckBins(data, h_integration_type, h_step, ChannelDepthStart, ChannelDepthEnd)
-        super().__init__(target_v_bins, source_v_bins, target_h_bins, source_h_bins)
+        super().__init__(target_v_bins, source_v_bins, target_h_bins, source_h_bins, engine)
         self.h_integration_type = h_integration_type
         self.data = data
         self.max_range = ChannelDepthEnd
@@ -27,25 +42,30 @@ class EKGridder(XGridder):
 
         sbins = None
         tbins = None
+        # Target bins are counted from the start of the survey, the bins before origin['bin'] are left out
+        first = self.origin['bin']
         if _type == 'ping':
-            sbins = xr.DataArray(np.arange(0, len(data['ping_time'])))
+            n = self.origin['ping'] + len(data['ping_time'])
+            sbins = xr.DataArray(np.arange(self.origin['ping'], n))
 
             if self.PingAxisIntervalOrigin == 'start':
-                tbins = xr.DataArray(np.arange(0, len(data['ping_time']), step))
+                tbins = xr.DataArray(np.arange(0, n, step)[first:])
             if self.PingAxisIntervalOrigin == 'middle':
-                tbins = xr.DataArray(np.arange(-step/2, len(data['ping_time']), step))
+                tbins = xr.DataArray(np.arange(-step/2, n, step)[first:])
 
-            self.ping_time = data['ping_time'].isel(ping_time=np.arange(0, len(data['ping_time']), step).astype(np.int32)).values
+            # The first bin can start before data, it is an edge bin
+            idx = np.arange(0, n, step)[first:] - self.origin['ping']
+            self.ping_time = data['ping_time'].isel(ping_time=np.maximum(idx, 0).astype(np.int32)).values
 
         elif _type == 'time':
-            sbins = self.calckTimeInSeconds(data['ping_time'])
+            sbins = self.calckTimeInSeconds(data['ping_time']) + self.startInSeconds(data)
 
             if self.PingAxisIntervalOrigin == 'start':
-                tbins = xr.DataArray(np.arange(0, sbins[-1].compute(), step))
+                tbins = xr.DataArray(np.arange(0, sbins[-1].compute(), step)[first:])
             if self.PingAxisIntervalOrigin == 'middle':
-                tbins = xr.DataArray(np.arange(-step/2, sbins[-1].compute(), step))
+                tbins = xr.DataArray(np.arange(-step/2, sbins[-1].compute(), step)[first:])
 
-            self.ping_time = np.arange(data['ping_time'][0].compute().values, data['ping_time'][-1].compute().values,np.timedelta64(int(step), 's'))
+            self.ping_time = np.arange(self.origin['time'], data['ping_time'][-1].compute().values,np.timedelta64(int(step), 's'))[first:]
 
         elif _type == 'nmi':
 
@@ -54,13 +74,13 @@ class EKGridder(XGridder):
             # Last distance can be nan, use previous
 
             if self.PingAxisIntervalOrigin == 'start':
-                tbins = xr.DataArray(np.arange(data['distance'][0], data['distance'][-1], step))
+                tbins = xr.DataArray(np.arange(self.origin['distance'], data['distance'][-1], step)[first:])
             if self.PingAxisIntervalOrigin == 'middle':
-                tbins = xr.DataArray(np.arange(data['distance'][0]-step/2, data['distance'][-1], step))
+                tbins = xr.DataArray(np.arange(self.origin['distance']-step/2, data['distance'][-1], step)[first:])
 
-            sec = self.calckTimeInSeconds(data['ping_time'])
+            sec = self.calckTimeInSeconds(data['ping_time']) + self.startInSeconds(data)
             isec = np.interp(tbins.compute().values, sbins.values, sec)
-            mtime = [data['ping_time'].values[0]+np.timedelta64(int(np.round(t*1000)), 'ms') for t in isec]
+            mtime = [self.origin['time']+np.timedelta64(int(np.round(t*1000)), 'ms') for t in isec]
             self.ping_time = np.array(mtime)
 
             """
@@ -100,6 +120,12 @@ class EKGridder(XGridder):
         return sbins, tbins
 
 
+    def startInSeconds(self, data):
+        """
+        Seconds from the start of the survey to the first ping of data
+        """
+        return (data['ping_time'].values[0] - self.origin['time']) / np.timedelta64(1, 's')
+
     def calckTimeInSeconds(self, mtime):
 
         dt = (mtime['ping_time'].diff('ping_time') / np.timedelta64(1, 's')).values
@@ -107,14 +133,22 @@ class EKGridder(XGridder):
 
         return xr.DataArray(np.cumsum(dt))
 
-    def regrid(self, data=None):
+    def _sv(self, data):
+
+        sv_s = data.fillna(0)
+        if 'category' in sv_s['sv'].dims:
+            # All categories are gridded in the same pass
+            return sv_s['sv'].transpose('category', 'ping_time', 'range')
+        return sv_s['sv'].squeeze()
 
+    @measure('grid coords')
+    def gridCoords(self, data=None):
+        """
+        Coordinates and per ping variables of data on the target grid, without sv
+        """
         if data is None:
             data = self.data
 
-        sv_s = data.fillna(0).squeeze()
-        gdata = super().regrid(sv_s['sv'])
-
         # Regrid axis
         data = data.sel(range=slice(0, 0))  # We dont ned values in range anymore
 
@@ -123,12 +157,36 @@ class EKGridder(XGridder):
         # Form correct data cars and coordinates on final grid
         data = data.drop(['range', 'sv'])
         data = data.assign_coords(range = self.target_v_bins.values)
-        gdata = dask.array.expand_dims(gdata, axis=0)
 
-        ds = xr.Dataset(data_vars=data.data_vars, coords=data.coords)
-        ds = ds.assign(sv=(['category', 'ping_time', 'range'], gdata))
+        return xr.Dataset(data_vars=data.data_vars, coords=data.coords)
+
+    def _assignSv(self, ds, gdata):
+        if gdata.ndim == 2:
+            gdata = dask.array.expand_dims(gdata, axis=0)
+
+        return ds.assign(sv=(['category', 'ping_time', 'range'], gdata))
+
+    def regrid(self, data=None):
+
+        if data is None:
+            data = self.data
+
+        gdata = super().regrid(self._sv(data))
+
+        return self._assignSv(self.gridCoords(data), gdata)
+
+    def regridWindow(self, window, coords=None):
+        """
+        Grid one window from windows(). coords is gridCoords(), which can be
+        computed once and shared by all the windows.
+        """
+        if coords is None:
+            coords = self.gridCoords()
+
+        b0, b1, _, _ = window
+        gdata = super().regridWindow(self._sv(self.data), window)
 
-        return ds
+        return self._assignSv(coords.isel(ping_time=slice(b0, b1)), gdata)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import dask
+import numpy as np
+import xarray as xr
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from Logger import Logger as Log
+from Metrics import measure
+
+"""
+    Echogram images of the report
+
+    The Sa values are pooled (max or mean, in the linear domain) down to the
+    pixels of the plot before the dB conversion, chunk by chunk and for all
+    categories in one pass over the report. The images are then rendered in
+    a process pool with the Agg backend, so a worker holds one pooled image
+    and the size of the survey does not matter to the rendering.
+"""
+
+FIGSIZE = (12, 6)
+DPI = 100
+# left, bottom, right, top of the axes
+ADJUST = (0.043, 0.067, 0.9, 0.95)
+
+
+def axesPixels():
+    """
+    (width, height) of the image axes in pixels
+    """
+    return (int(np.ceil(FIGSIZE[0] * DPI * (ADJUST[2] - ADJUST[0]))),
+            int(np.ceil(FIGSIZE[1] * DPI * (ADJUST[3] - ADJUST[1]))))
+
+
+def pool(da, sizes, how='mean'):
+    """
+    da pooled with max or mean over blocks of bins, so it has at most sizes[dim] bins along each dim in sizes.
+    The coordinates are dropped, nan is skipped. Lazy when da is.
+    """
+    if how not in ['max', 'mean']:
+        raise ValueError('{} pooling not defined'.format(how))
+
+    windows = {dim: int(np.ceil(da.sizes[dim] / n)) for dim, n in sizes.items()}
+    windows = {dim: w for dim, w in windows.items() if w > 1}
+    da = xr.DataArray(da.data, dims=da.dims)
+    if not windows:
+        return da
+
+    if da.chunks is not None:
+        # Whole windows in each chunk
+        da = da.chunk({dim: w * max(1, da.chunksizes[dim][0] // w) for dim, w in windows.items()})
+    coarse = da.coarsen(windows, boundary='pad')
+    return coarse.max() if how == 'max' else coarse.mean()
+
+
+def _render(image, extent, title, ylabel, fname, vmin, vmax):
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_title(title)
+
+    im = ax.imshow(10 * np.log10(image.T + 10e-20), vmin=vmin, vmax=vmax, extent=extent, origin='upper',
+                   interpolation='nearest')
+    ax.set_ylabel(ylabel)
+
+    # Format time axis
+    locator = mdates.AutoDateLocator(minticks=3, maxticks=20)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+
+    ax.axis('auto')
+    ax.axis('tight')
+    fig.subplots_adjust(*ADJUST)
+
+    # Make colorbar tighter
+    cax = fig.add_axes([ax.get_position().x1 + 0.01, ax.get_position().y0, 0.02, ax.get_position().height])
+    fig.colorbar(im, cax=cax)
+
+    fig.savefig(fname)
+    return fname
+
+
+@measure('echograms')
+def saveEchograms(ds, file_path, ylabel, how='mean', processes=None, vmin=-80, vmax=-20):
+    """
+    One echogram per category of the report ds, to file_path_<category>.png
+    how       : 'max' or 'mean' pooling of the bins in a pixel
+    processes : rendering processes, by default one per category up to the number of cores
+    """
+    width, height = axesPixels()
+    value = ds['value'].transpose('SaCategory', 'Time', 'ChannelDepthUpper')
+    images = pool(value, {'Time': width, 'ChannelDepthUpper': height}, how)
+    Log().info('Pooling {} to {} pixels per category'.format(dict(value.sizes), images.shape[1:]))
+    images = np.asarray(dask.compute(images)[0])
+
+    times = mdates.date2num(ds['Time'].values[[0, -1]])
+    depths = ds['ChannelDepthUpper'].values
+    extent = [times[0], times[-1], depths[-1], depths[0]]
+    channel = ds['channel_id'].values if 'channel_id' in ds else ''
+
+    jobs = [(images[i], extent, '{} @ {}'.format(cat, channel), ylabel, '{}_{}.png'.format(file_path, cat), vmin, vmax)
+            for i, cat in enumerate(ds['SaCategory'].values)]
+    _renderAll(_render, jobs, processes)
+
+
+def _renderLine(times, line, title, fname):
+    fig = Figure(dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(times, line)
+    ax.set_title(title)
+    ax.set_xlabel('Time')
+    ax.set_ylabel('value')
+    fig.autofmt_xdate()
+    fig.savefig(fname)
+    return fname
+
+
+@measure('integration images')
+def saveIntegrationImages(ds, dst_dir, how='mean', processes=None):
+    """
+    The value summed over the channels against Time, per category of the report ds, to dst_dir/cat_<category>.png
+    """
+    width = int(Figure(dpi=DPI).get_size_inches()[0] * DPI)
+    value = ds['value'].transpose('SaCategory', 'Time', 'ChannelDepthUpper').sum('ChannelDepthUpper')
+    lines = pool(value, {'Time': width}, how)
+    lines = np.asarray(dask.compute(lines)[0])
+
+    # The first Time of each pixel
+    times = ds['Time'].values[::int(np.ceil(ds.sizes['Time'] / lines.shape[1]))]
+
+    os.makedirs(dst_dir, exist_ok=True)
+    jobs = [(times, lines[i], 'SaCategory = {}'.format(cat), os.path.join(dst_dir, 'cat_{}.png'.format(cat)))
+            for i, cat in enumerate(ds['SaCategory'].values)]
+    _renderAll(_renderLine, jobs, processes)
+
+
+def _renderAll(render, jobs, processes=None):
+    # render(*job) for the jobs, in a process pool of one per job up to the number of cores
+    processes = processes or min(len(jobs), os.cpu_count())
+    if processes <= 1:
+        for job in jobs:
+            Log().info('Generating image : {}'.format(render(*job)))
+        return
+
+    # Spawned, as the dask processes scheduler, the parent has threads running
+    context = multiprocessing.get_context(dask.config.get('multiprocessing.context', 'spawn'))
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        for fname in executor.map(render, *zip(*jobs)):
+            Log().info('Generating image : {}'.format(fname))
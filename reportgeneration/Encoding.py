@@ -0,0 +1,180 @@
+import numpy as np
+from numcodecs import Blosc, Categorize, Delta, Quantize
+
+"""
+    Named zarr encodings for the report
+
+    A profile sets the compressor, the filters and the Time chunk of the report.
+    The Sa values are always stored lossless. They are mostly zeros, which compress
+    better without shuffle, while the smooth per ping variables are bit shuffled.
+    The archive profile quantizes the positions and the per ping variables, to well
+    below their measurement accuracy.
+    Constant and categorical string coordinates (Origin, Origin2, Validity) are
+    stored as one byte codes instead of repeated strings, and Time as deltas.
+
+    python Encoding.py benchmarks the profiles on a synthetic report
+"""
+
+PROFILES = {
+    # The encoding the report has always been written with
+    'default': {'cname': 'zstd', 'clevel': 3, 'shuffle': Blosc.BITSHUFFLE,
+                'time_chunk': None, 'quantize': {}, 'delta_time': False, 'categorical': False},
+    # Smallest store, slow to write
+    'archive': {'cname': 'zstd', 'clevel': 5, 'shuffle': Blosc.NOSHUFFLE,
+                'time_chunk': 4096,
+                'quantize': {'Latitude': 6, 'Longitude': 6, 'Latitude2': 6, 'Longitude2': 6,  # ~0.1 m
+                             'Distance': 5, 'BottomDepth': 2, 'heave': 3, 'transducer_draft': 3},
+                'delta_time': True, 'categorical': True},
+    # Cheapest compression, chunks as gridded
+    'fast-write': {'cname': 'lz4', 'clevel': 1, 'shuffle': Blosc.NOSHUFFLE,
+                   'time_chunk': None, 'quantize': {}, 'delta_time': False, 'categorical': True},
+    # Fast decompression and few, large chunks along Time
+    'fast-read': {'cname': 'lz4', 'clevel': 9, 'shuffle': Blosc.NOSHUFFLE,
+                  'time_chunk': 2048, 'quantize': {}, 'delta_time': True, 'categorical': True},
+}
+
+
+def timeChunk(profile, default):
+    """
+    Time chunk of the Sa values for profile, default when the profile follows the gridding
+    """
+    return PROFILES[profile]['time_chunk'] or default
+
+
+def encoding(ds, profile='default', chunks=None):
+    """
+    to_zarr encoding of the report ds for profile.
+    chunks : {dim: size} of the variables along SaCategory, dims not in chunks are not split
+    """
+    p = PROFILES[profile]
+    compressor = Blosc(cname=p['cname'], clevel=p['clevel'], shuffle=p['shuffle'])
+    coord_compressor = Blosc(cname=p['cname'], clevel=p['clevel'], shuffle=Blosc.BITSHUFFLE)
+
+    # The default profile only ever set the data variables
+    names = list(ds.data_vars) if profile == 'default' else list(ds.variables)
+
+    enc = {}
+    for var in names:
+        if ds[var].ndim == 0:
+            continue
+        enc[var] = {'compressor': compressor if 'SaCategory' in ds[var].dims or profile == 'default' else coord_compressor}
+        filters = []
+
+        if var in p['quantize'] and ds[var].dtype.kind == 'f':
+            filters.append(Quantize(p['quantize'][var], dtype=ds[var].dtype.str))
+
+        if var == 'Time' and p['delta_time']:
+            enc[var].update({'units': 'nanoseconds since 1970-01-01', 'dtype': 'int64'})
+            filters.append(Delta(dtype='<i8'))
+
+        if ds[var].dtype.kind in 'UO' and p['categorical']:
+            labels = [str(label) for label in np.unique(ds[var].values)]
+            if len(labels) < 256:
+                filters.append(Categorize(labels, dtype=ds[var].dtype.str if ds[var].dtype.kind == 'U' else object, astype='u1'))
+
+        if filters:
+            enc[var]['filters'] = filters
+
+        if chunks is not None and 'SaCategory' in ds[var].dims:
+            enc[var]['chunks'] = tuple(chunks.get(dim, ds.sizes[dim]) for dim in ds[var].dims)
+
+    return enc
+
+
+def syntheticReport(n_time=20000, n_depth=100, n_cat=4, seed=0):
+    """
+    Report shaped as formatToRapport, with mostly empty cells as in real surveys
+    """
+    import pandas as pd
+    import xarray as xr
+
+    rng = np.random.default_rng(seed)
+
+    value = rng.lognormal(0, 2, (n_cat, n_time, n_depth)) * 1e-5
+    value[rng.random(value.shape) > 0.1] = 0
+    depth = np.arange(n_depth) * 5.0
+    time = pd.date_range('2019-05-01', periods=n_time, freq='37s').values + rng.integers(0, 10**6, n_time).astype('timedelta64[ns]')
+    lat = 60 + np.cumsum(rng.normal(0, 1e-4, n_time))
+    lon = 5 + np.cumsum(rng.normal(1e-3, 1e-4, n_time))
+    draft = np.repeat(rng.normal(6, 0.1, (1, n_time)), n_cat, axis=0)
+
+    return xr.Dataset(
+        {'value': (('SaCategory', 'Time', 'ChannelDepthUpper'), value),
+         'heave': (('SaCategory', 'Time'), rng.normal(0, 0.3, (n_cat, n_time))),
+         'transducer_draft': (('SaCategory', 'Time'), draft)},
+        coords={'SaCategory': np.arange(n_cat),
+                'Time': time,
+                'ChannelDepthUpper': depth,
+                'ChannelDepthLower': ('ChannelDepthUpper', np.append(depth[1:], np.nan)),
+                'Latitude': ('Time', lat),
+                'Longitude': ('Time', lon),
+                'Latitude2': ('Time', np.append(lat[1:], np.nan)),
+                'Longitude2': ('Time', np.append(lon[1:], np.nan)),
+                'Origin': ('Time', np.repeat('start', n_time)),
+                'Origin2': ('Time', np.repeat('end', n_time)),
+                'Validity': ('Time', np.repeat('V', n_time)),
+                'Distance': ('Time', np.arange(n_time) * 0.1),
+                'BottomDepth': ('Time', rng.normal(200, 20, n_time))})
+
+
+def benchmark(ds, profiles=None, gridded_chunk=512, dst=None):
+    """
+    Write and read ds with each profile, returns a row per profile with
+    size (MB), compression ratio, write and read throughput (MB/s of raw data)
+    and the largest error on the quantized variables
+    """
+    import os
+    import shutil
+    import tempfile
+    import time
+    import xarray as xr
+
+    profiles = list(PROFILES) if profiles is None else profiles
+    tmp = tempfile.mkdtemp() if dst is None else None
+    dst = tmp or dst
+    raw = ds.nbytes / 1024**2
+
+    rows = []
+    for profile in profiles:
+        fname = os.path.join(dst, f'{profile}.zarr')
+        t_chunk = timeChunk(profile, gridded_chunk)
+        data = ds.chunk({'Time': t_chunk})
+
+        t0 = time.time()
+        data.to_zarr(fname, mode='w', encoding=encoding(data, profile, {'SaCategory': 1, 'Time': t_chunk}))
+        t_write = time.time() - t0
+
+        t0 = time.time()
+        back = xr.open_zarr(fname).load()
+        t_read = time.time() - t0
+
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(fname) for f in files) / 1024**2
+        error = max(float(np.nanmax(np.abs(back[var].values - ds[var].values)))
+                    for var in PROFILES[profile]['quantize'] if var in ds) if PROFILES[profile]['quantize'] else 0.0
+        assert (back['value'].values == ds['value'].values).all()
+
+        rows.append({'profile': profile, 'size': size, 'ratio': raw / size,
+                     'write': raw / t_write, 'read': raw / t_read, 'error': error})
+        shutil.rmtree(fname)
+
+    if tmp is not None:
+        shutil.rmtree(tmp)
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Size and throughput of the report encoding profiles')
+    parser.add_argument("--time", type=int, default=20000, help="Time bins of the synthetic report")
+    parser.add_argument("--depth", type=int, default=100, help="Depth channels of the synthetic report")
+    parser.add_argument("--categories", type=int, default=4, help="Categories of the synthetic report")
+    parser.add_argument("--profile", type=str, nargs='+', choices=list(PROFILES), help="Profiles to benchmark, all by default")
+    parser.add_argument("--dst", type=str, help="Directory to write the test stores in, a temporary directory by default")
+    args = parser.parse_args()
+
+    ds = syntheticReport(args.time, args.depth, args.categories)
+    print(f'Synthetic report {dict(ds.sizes)}, {ds.nbytes / 1024**2:.1f} MB')
+    print(f'{"profile":<12}{"size MB":>10}{"ratio":>8}{"write MB/s":>12}{"read MB/s":>11}{"max error":>11}')
+    for row in benchmark(ds, args.profile, dst=args.dst):
+        print(f'{row["profile"]:<12}{row["size"]:>10.2f}{row["ratio"]:>8.1f}{row["write"]:>12.1f}{row["read"]:>11.1f}{row["error"]:>11.2g}')
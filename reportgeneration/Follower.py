@@ -0,0 +1,148 @@
+import os
+import time
+import numpy as np
+import xarray as xr
+import zarr
+from Logger import Logger as Log
+from Encoding import PROFILES
+import reportgeneration.Reportgenerator as rg
+from Metrics import Instrument
+
+"""
+    Keeps a report up to date with input stores that are still being written
+
+    The inputs are polled by reading the ping_time metadata of the zarr stores.
+    When the report lags the newest ping by at least the latency target, the new
+    pings are gridded and appended to the report, see the append in Reportgenerator.
+"""
+
+
+def lastPingTime(fname):
+    """
+    Last ping_time in a zarr store, read from the ping_time array alone.
+    None if the store, or any ping, is not there yet.
+    """
+    try:
+        ping_time = zarr.open_group(fname, mode='r')['ping_time']
+    except (KeyError, ValueError):
+        return None
+
+    if ping_time.shape[0] == 0:
+        return None
+
+    attrs = {k: v for k, v in ping_time.attrs.items() if k != '_ARRAY_DIMENSIONS'}
+    last = xr.Dataset({'ping_time': (('ping_time',), ping_time[-1:], attrs)})
+    return xr.decode_cf(last)['ping_time'].values[0]
+
+
+class Follower:
+
+    def __init__(self, grid_fname, pred_fname, bot_fname, out_fname, poll_interval=60, latency=300, idle_timeout=None, **kwargs):
+        """
+        poll_interval : Seconds between each check of the inputs
+        latency       : The report is updated when the newest ping is this many seconds newer than the report
+        idle_timeout  : Stop when there has been no new pings for this many seconds, None follows forever
+        kwargs        : Reportgenerator parameters
+        """
+        self.grid_fname = grid_fname
+        self.pred_fname = pred_fname
+        self.bot_fname = bot_fname
+        self.out_fname = out_fname
+        self.poll_interval = poll_interval
+        self.latency = np.timedelta64(int(latency * 1e9), 'ns')
+        self.idle_timeout = idle_timeout
+        self.kwargs = kwargs
+
+    def newestPing(self):
+        """
+        Newest ping that is in all the inputs
+        """
+        fnames = [self.grid_fname, self.pred_fname] + ([] if self.bot_fname is None else [self.bot_fname])
+        last = [lastPingTime(fname) for fname in fnames]
+        if any(t is None for t in last):
+            return None
+        return min(last)
+
+    def reportedPing(self):
+        """
+        Last ping in the report, None if there is no report yet
+        """
+        if not os.path.exists(self.out_fname):
+            return None
+        last = zarr.open_group(self.out_fname, mode='r').attrs.get('LastPingTime')
+        return None if last is None else np.datetime64(last)
+
+    def update(self, end_time):
+        t0 = time.time()
+        with Instrument(self.out_fname), rg.Reportgenerator(self.grid_fname, self.pred_fname, self.bot_fname, self.out_fname,
+                                                            end_time=end_time, **self.kwargs) as rep:
+            rep.saveGridd(self.out_fname)
+
+        if os.path.exists(self.out_fname):
+            zarr.consolidate_metadata(self.out_fname)
+        Log().info(f'Report updated to {self.reportedPing()} in {time.time() - t0:.1f} s')
+
+    def run(self):
+        Log().info(f'Following {self.grid_fname}, poll interval {self.poll_interval} s, latency {self.latency}')
+
+        last_new = time.time()
+        last_seen = None
+        while True:
+            newest = self.newestPing()
+            if newest is not None and newest != last_seen:
+                last_seen = newest
+                last_new = time.time()
+
+            reported = self.reportedPing()
+            if newest is not None and (reported is None or (newest > reported and newest - reported >= self.latency)):
+                try:
+                    self.update(newest)
+                except Exception as e:
+                    # The inputs can be mid write, try again at the next poll
+                    Log().error(f'Report update failed: {e}')
+
+            if self.idle_timeout is not None and time.time() - last_new > self.idle_timeout:
+                Log().info(f'No new pings for {self.idle_timeout} s, stop following')
+                break
+
+            time.sleep(self.poll_interval)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, help="Acoustic Sv data")
+    parser.add_argument("--pred", type=str, help="Predictions")
+    parser.add_argument("--bot", type=str, help="Bottom data")
+    parser.add_argument("--out", type=str, help="Out data file")
+    parser.add_argument("--freq", type=float, default=38000, help="Frequency to gridd")
+    parser.add_argument("--thr", type=float, default=-100, help="Sv threshold")
+    parser.add_argument("--vtype", type=str, choices=['range', 'depth'], default='depth', help="Type of vertical integration")
+    parser.add_argument("--vstep", type=float, default=5, help="Step unit for vertical integration : meters")
+    parser.add_argument("--htype", type=str, choices=['ping', 'time', 'nmi'], default='nmi', help="Type of horizontal integration")
+    parser.add_argument("--hstep", type=float, default=0.1, help="Step unit for horizontal integration : #pings | seconds | nautical miles)")
+    parser.add_argument("--depth_start", type=float, default=0, help="Start range/depth to integrate over (m)")
+    parser.add_argument("--depth_end", type=float, default=500, help="End range/depth to integrate over (m)")
+    parser.add_argument("--poll_interval", type=float, default=60, help="Seconds between each check for new pings")
+    parser.add_argument("--latency", type=float, default=300, help="Update the report when it lags the newest ping by this many seconds")
+    parser.add_argument("--profile", type=str, choices=list(PROFILES), default='default', help="Encoding of the report store")
+    parser.add_argument("--pyramid", type=int, choices=[0, 1], default=0, help="Also keep a multiscale pyramid of the report")
+    parser.add_argument("--idle_timeout", type=float, help="Stop after this many seconds without new pings")
+
+    args = parser.parse_args()
+
+    Follower(args.data, args.pred, args.bot, args.out,
+             poll_interval=args.poll_interval,
+             latency=args.latency,
+             idle_timeout=args.idle_timeout,
+             freq=args.freq,
+             SvThreshold=args.thr,
+             vtype=args.vtype,
+             vstep=args.vstep,
+             htype=args.htype,
+             hstep=args.hstep,
+             ChannelDepthStart=args.depth_start,
+             ChannelDepthEnd=args.depth_end,
+             profile=args.profile,
+             pyramid=bool(args.pyramid)).run()
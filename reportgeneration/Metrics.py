@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import cProfile
+import platform
+import datetime
+import threading
+from contextlib import contextmanager
+from functools import wraps
+import dask
+from dask.callbacks import Callback
+import numpy as np
+import xarray as xr
+import psutil
+from Logger import Logger as Log
+from Resources import Singleton
+
+"""
+    Run metrics of the report generation
+
+    The stages of Reportgenerator, the gridders and the writers are measured with
+    wall time, cpu time, bytes read and written and peak memory (of the process
+    and its worker processes), and the number of dask computes and tasks run
+    while the stage was open. The tasks are counted on the local schedulers,
+    the distributed scheduler does not report them. Stages nest, and calls of a
+    stage with the same path are summed, e.g. the weights of every window.
+
+    Instrument collects the metrics of a run and writes them as json next to the
+    report, <report>_metrics.json. It can also profile the run with cProfile,
+    <report>_profile.prof, and write a dask performance report of the distributed
+    scheduler, <report>_dask.html.
+"""
+
+# Seconds between the memory samples
+SAMPLE_INTERVAL = 0.05
+
+
+def metricsName(fname):
+    """
+    The metrics file of the report fname
+    """
+    return os.path.splitext(fname)[0] + '_metrics.json'
+
+
+class _TaskCounter(Callback):
+    # Graphs and tasks run by the local schedulers
+
+    def __init__(self):
+        super().__init__()
+        self.computes = 0
+        self.tasks = 0
+
+    def _start(self, dsk):
+        self.computes += 1
+        self.tasks += len(dsk)
+
+
+class Metrics(Singleton):
+    """
+    The measured stages of the process. Stages are only measured in the main
+    thread, a measured function called from a dask task is not a stage.
+    """
+
+    def init(self):
+        self.process = psutil.Process()
+        self.counter = _TaskCounter()
+        self.counter.register()
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.open = []
+        self.info = {}
+        self.start = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
+
+    def annotate(self, **info):
+        """
+        Add the size of the data, or anything else describing the run, to the metrics
+        """
+        self.info.update(info)
+
+    def _processes(self):
+        # The process and its live worker processes
+        processes = [self.process]
+        try:
+            processes += self.process.children(recursive=True)
+        except psutil.Error:
+            pass
+        return processes
+
+    def _rss(self):
+        rss = 0
+        for p in self._processes():
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _counters(self):
+        # cpu seconds and bytes read and written so far, the finished children included in the cpu time
+        t = self.process.cpu_times()
+        cpu = t.user + t.system + t.children_user + t.children_system
+        if not hasattr(self.process, 'io_counters'):
+            # Not on this platform
+            return cpu, None, None
+
+        read, written = 0, 0
+        for p in self._processes():
+            try:
+                if p is not self.process:
+                    t = p.cpu_times()
+                    cpu += t.user + t.system
+                io = p.io_counters()
+            except psutil.Error:
+                # Gone, or not ours
+                continue
+            read += getattr(io, 'read_chars', io.read_bytes)
+            written += getattr(io, 'write_chars', io.write_bytes)
+        return cpu, read, written
+
+    def _sample(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            if self.open:
+                rss = self._rss()
+                with self.lock:
+                    for stage in self.open:
+                        stage['peak'] = max(stage['peak'], rss)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure the code run inside it as the stage name, within the open stages
+        """
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+
+        path = '/'.join([s['path'] for s in self.open[-1:]] + [name])
+        self.stages.setdefault(path, {'calls': 0})
+        cpu, read, written = self._counters()
+        stage = {'path': path, 'cpu': cpu, 'read': read, 'written': written, 'peak': self._rss(),
+                 'computes': self.counter.computes, 'tasks': self.counter.tasks, 't0': time.perf_counter()}
+        with self.lock:
+            self.open.append(stage)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - stage['t0']
+            with self.lock:
+                self.open.remove(stage)
+            cpu, read, written = self._counters()
+            self._add(path, {'wall_s': wall,
+                             'cpu_s': cpu - stage['cpu'],
+                             'read_mb': None if read is None or stage['read'] is None else (read - stage['read']) / 1024**2,
+                             'written_mb': None if written is None or stage['written'] is None else (written - stage['written']) / 1024**2,
+                             'dask_computes': self.counter.computes - stage['computes'],
+                             'dask_tasks': self.counter.tasks - stage['tasks']},
+                      max(stage['peak'], self._rss()) / 1024**2)
+
+    def _add(self, path, values, peak):
+        record = self.stages[path]
+        record['calls'] += 1
+        for k, v in values.items():
+            record[k] = None if v is None or record.get(k, 0) is None else record.get(k, 0) + v
+        record['peak_rss_mb'] = max(record.get('peak_rss_mb', 0), peak)
+
+    def summary(self):
+        """
+        The run and its stages, in the order they started
+        """
+        client = None
+        try:
+            from dask.distributed import default_client
+            client = default_client()
+        except (ImportError, ValueError):
+            pass
+
+        return {'run': {'start': self.start,
+                        'commit': os.getenv('COMMIT_SHA', 'NA'),
+                        'host': platform.node(),
+                        'cpus': os.cpu_count(),
+                        'scheduler': 'distributed' if client is not None else dask.config.get('scheduler', 'threads'),
+                        'workers': dask.config.get('num_workers', None),
+                        'python': platform.python_version(),
+                        'versions': {m.__name__: m.__version__ for m in [np, xr, dask]}},
+                'info': self.info,
+                'stages': [dict(stage=path, **record) for path, record in self.stages.items() if record['calls']]}
+
+    def write(self, fname):
+        """
+        The summary as json to fname, and the top level stages to the log
+        """
+        summary = self.summary()
+        with open(fname, 'w') as f:
+            json.dump(summary, f, indent=1, default=str)
+
+        for s in summary['stages']:
+            if s['stage'].count('/') <= 1:
+                Log().info('{:<40} {:8.1f} s wall {:8.1f} s cpu {:8.0f} MB peak {:7d} tasks'.format(
+                    s['stage'], s['wall_s'], s['cpu_s'], s['peak_rss_mb'], s['dask_tasks']))
+        Log().info(f'Run metrics written to : {fname}')
+
+
+def measure(name=None):
+    """
+    Decorator measuring each call of a function as a stage, named after the function by default
+    """
+    def decorator(func):
+        @wraps(func)
+        def measured(*args, **kwargs):
+            with Metrics().stage(name or func.__qualname__):
+                return func(*args, **kwargs)
+        return measured
+    return decorator
+
+
+class Instrument:
+    """
+    Context manager collecting the metrics of everything run inside it, as the stage 'run',
+    and writing them next to the report fname when it exits, also when the run fails.
+    cprofile    : profile the run with cProfile, to <report>_profile.prof
+    dask_report : write a dask performance report to <report>_dask.html, with the distributed scheduler
+    """
+
+    def __init__(self, fname, cprofile=False, dask_report=False):
+        self.fname = fname
+        self.cprofile = cprofile
+        self.dask_report = dask_report
+        self.profiler = None
+        self.report = None
+
+    def __enter__(self):
+        Metrics().reset()
+        base = os.path.splitext(self.fname)[0]
+
+        if self.dask_report:
+            try:
+                from dask.distributed import default_client, performance_report
+                default_client()
+                self.report = performance_report(filename=base + '_dask.html')
+                self.report.__enter__()
+            except (ImportError, ValueError):
+                Log().warning('A dask performance report needs the distributed scheduler, not written')
+
+        if self.cprofile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.stage = Metrics().stage('run')
+        self.stage.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stage.__exit__(type, value, traceback)
+        base = os.path.splitext(self.fname)[0]
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(base + '_profile.prof')
+            Log().info(f'cProfile output written to : {base}_profile.prof')
+        if self.report is not None:
+            self.report.__exit__(type, value, traceback)
+            Log().info(f'Dask performance report written to : {base}_dask.html')
+
+        if value is not None:
+            Metrics().annotate(error=repr(value))
+        if os.path.exists(os.path.dirname(os.path.abspath(self.fname))):
+            Metrics().write(metricsName(self.fname))
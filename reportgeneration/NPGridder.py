@@ -1,5 +1,8 @@
 from enum import Enum, auto
 import numpy as np
+from scipy import sparse
+from WeightCache import WeightCache
+from Metrics import measure
 
 
 class GridType(Enum):
@@ -44,94 +47,108 @@ class NPGridder:
         bin_r_s = np.append(r_s[0] - (r_s[1] - r_s[0]) / 2, (r_s[0:-1] + r_s[1:]) / 2)
         bin_r_s = np.append(bin_r_s, r_s[-1] + (r_s[-1] - r_s[-2]) / 2)
 
-        # Initialize W matrix (sparse)
-
-        W = np.zeros([len(r_t), len(r_s) + 1])
+        # W is built directly in CSR form, all target bins at once
         # NB: + 1 length for space to NaNs in edge case
 
-        # Loop over the target bins
-        for i, rt in enumerate(r_t):
-
-            # Check that this is not an edge case
-            if bin_r_t[i] > bin_r_s[0] and bin_r_t[i + 1] < bin_r_s[-1]:
-                # The size of the target bin
-                # example target bin:  --[---[---[---[-
-                drt = bin_r_t[i + 1] - bin_r_t[i]  # From example: drt = 4
-                #drt=1
-                # find the indices in source
-                j0 = np.searchsorted(bin_r_s, bin_r_t[i], side='right') - 1
-                j1 = np.searchsorted(bin_r_s, bin_r_t[i + 1], side='right')
-
-                # CASE 1: Target higher resolution, overlapping 1 source bin
-                # target idx     i    i+1
-                # target    -----[-----[-----
-                # source    --[-----------[--
-                # source idx  j0          j1
-
-                if j1 - j0 == 1:
-                    W[i, j0] = 1
-
-                # CASE 2: Target higher resolution, overlapping 1 source bin
-                # target idx      i   i+1
-                # target    --[---[---[---[-
-                # source    -[------[------[-
-                # source idx j0            j1
-
-                elif j1 - j0 == 2:
-                    W[i, j0] = (bin_r_s[j0 + 1] - bin_r_t[i]) / drt
-                    W[i, j1 - 1] = (bin_r_t[i + 1] - bin_r_s[j1 - 1]) / drt
-
-                # CASE 3: Target lower resolution
-                # target idx    i       i+1
-                # target    ----[-------[----
-                # source    --[---[---[---[--
-                # source idx  j0          j1
-
-                elif j1 - j0 > 2:
-                    for j in range(j0, j1):
-                        if j == j0:
-                            W[i, j] = (bin_r_s[j + 1] - bin_r_t[i]) / drt
-                        elif j == j1 - 1:
-                            W[i, j] = (bin_r_t[i + 1] - bin_r_s[j]) / drt
-                        else:
-                            W[i, j] = (bin_r_s[j + 1] - bin_r_s[j]) / drt
-
-            #  Edge case 1
-            # target idx    i       i+1
-            # target    ----[-------[----
-            # source        #end# [---[---[
-            # source idx          j0  j1
-
-            #  Edge case 2
-            # target idx    i       i+1
-            # target    ----[-------[----
-            # source    --[---[ #end#
-            # source idx  j0  j1
-            else:
-                # Edge case (NaN must be in W, not in sv_s.
-                # Or else np.dot failed)
-                W[i, -1] = np.nan
+        # Target bin i is the interval bin_r_t[i], bin_r_t[i + 1]
+        t0 = bin_r_t[:-1]
+        t1 = bin_r_t[1:]
+
+        # Check that this is not an edge case
+        inside = (t0 > bin_r_s[0]) & (t1 < bin_r_s[-1])
+
+        # The size of the target bin
+        # example target bin:  --[---[---[---[-
+        drt = t1 - t0  # From example: drt = 4
+
+        # find the indices in source
+        j0 = np.searchsorted(bin_r_s, t0, side='right') - 1
+        j1 = np.searchsorted(bin_r_s, t1, side='right')
+
+        # One element per overlapping source bin j0 <= j < j1, one element for the edge cases
+        count = np.where(inside, j1 - j0, 1)
+        indptr = np.append(0, np.cumsum(count))
+        rows = np.repeat(np.arange(len(r_t)), count)
+        j = np.where(inside[rows], j0[rows] + np.arange(indptr[-1]) - indptr[rows], len(r_s))
+
+        # The weight is the overlap between the source and target bin,
+        # relative to the target bin. This covers all three cases:
+
+        # CASE 1: Target higher resolution, overlapping 1 source bin
+        # target idx     i    i+1
+        # target    -----[-----[-----
+        # source    --[-----------[--
+        # source idx  j0          j1
+
+        # CASE 2: Target higher resolution, overlapping 1 source bin
+        # target idx      i   i+1
+        # target    --[---[---[---[-
+        # source    -[------[------[-
+        # source idx j0            j1
+
+        # CASE 3: Target lower resolution
+        # target idx    i       i+1
+        # target    ----[-------[----
+        # source    --[---[---[---[--
+        # source idx  j0          j1
+
+        js = np.minimum(j, len(r_s) - 1)
+        overlap = np.minimum(bin_r_s[js + 1], t1[rows]) - np.maximum(bin_r_s[js], t0[rows])
+
+        #  Edge case 1
+        # target idx    i       i+1
+        # target    ----[-------[----
+        # source        #end# [---[---[
+        # source idx          j0  j1
+
+        #  Edge case 2
+        # target idx    i       i+1
+        # target    ----[-------[----
+        # source    --[---[ #end#
+        # source idx  j0  j1
+
+        # Edge case (NaN must be in W, not in sv_s.
+        # Or else np.dot failed)
+        vals = np.where(inside[rows], overlap / drt[rows], np.nan)
+
+        W = sparse.csr_matrix((vals, j, indptr), shape=(len(r_t), len(r_s) + 1))
         return W
 
+    def _weight(self, r_t, r_s):
+        # Identical bins give identical weights, reuse them across gridders and runs
+        return WeightCache().get(r_t, r_s, self._resampleWeight)
+
+    def _splitWeight(self, W):
+        """
+        Split W into the weights over the source bins and a boolean vector
+        of the edge bins, i.e. the rows holding NaN in the last column.
+        The edge bins are set to NaN after the product instead of
+        multiplying NaN with an extra row of zeros.
+        """
+        edge = np.isnan(W[:, -1].toarray().ravel())
+        return W[:, :-1].tocsr(), edge
 
     def _regrid(self, W, data):
         # Regridd
-        data_mod = np.vstack((data, np.zeros(data.shape[1])))
-        return np.dot(W, data_mod)
+        W, edge = self._splitWeight(W)
+        gridded = np.asarray(W.dot(data), dtype=float)
+        gridded[edge] = np.nan
+        return gridded
 
+    @measure('regrid')
     def regrid(self, data):
 
         if self.griddType == GridType.OneDimension:
-            W = self._resampleWeight(self.target_v_bins, self.source_v_bins)
+            W = self._weight(self.target_v_bins, self.source_v_bins)
             data = self._regrid(W, data.T).T
 
             return data
 
         elif self.griddType == GridType.TwoDimension:
-            W = self._resampleWeight(self.target_v_bins, self.source_v_bins)
+            W = self._weight(self.target_v_bins, self.source_v_bins)
             data = self._regrid(W, data.T).T
 
-            W = self._resampleWeight(self.target_h_bins, self.source_h_bins)
+            W = self._weight(self.target_h_bins, self.source_h_bins)
             data = self._regrid(W, data)
 
             return data
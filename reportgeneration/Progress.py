@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from dask.callbacks import Callback
+from Logger import Logger as Log
+from Metrics import Metrics
+from Resources import Singleton
+
+"""
+    Progress of a run, logged while it runs
+
+    Reportgenerator tells the progress the pings of the run and of each step,
+    a window, or the whole survey when it is written in one pass. Within a step
+    the pings done are estimated from the dask tasks done, counted with a
+    callback on the local schedulers. With the distributed scheduler the
+    progress moves a step at a time.
+
+    ProgressReporter logs the stage, pings done, pings/s and MB/s read since the
+    last report, the ETA from the mean rate and the memory in use every interval
+    seconds, and optionally writes the same to a json file for polling. The file
+    is replaced in one rename, so a reader never sees it half written.
+"""
+
+
+class _Tasks(Callback):
+    # Tasks of the computes of the current step
+
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+
+    def _start(self, dsk):
+        self.progress.tasks += len(dsk)
+
+    def _posttask(self, key, result, dsk, state, id):
+        self.progress.tasks_done += 1
+
+
+class Progress(Singleton):
+    """
+    The progress of the current run
+    """
+
+    def init(self):
+        self.begin(None)
+
+    def begin(self, pings):
+        """
+        A run of pings source pings starts, None when not known yet
+        """
+        self.pings = pings
+        self.done = 0
+        self.stage = 'setup'
+        self.step_pings = 0
+        self.tasks = 0
+        self.tasks_done = 0
+        self.started = None
+        self.open = False
+        # The last estimate, so it does not go back when a step runs another compute
+        self.estimate = 0
+
+    def setStage(self, stage):
+        """
+        Work on the report that does not process pings, e.g. the writers
+        """
+        self.stage = stage
+        self.tasks = 0
+        self.tasks_done = 0
+
+    @contextmanager
+    def step(self, stage, pings):
+        """
+        Process pings source pings inside it, they are done when it exits.
+        A step inside another step is part of it.
+        """
+        if self.open:
+            yield
+            return
+
+        self.open = True
+        self.setStage(stage)
+        self.step_pings = pings or 0
+        if self.started is None:
+            self.started = time.time()
+        try:
+            yield
+        finally:
+            self.done += self.step_pings
+            self.step_pings = 0
+            self.open = False
+
+    def pingsDone(self):
+        """
+        Pings done, those of the current step estimated from its dask tasks
+        """
+        done = self.done
+        if self.tasks:
+            done += self.step_pings * self.tasks_done / self.tasks
+        self.estimate = max(self.estimate, done if self.pings is None else min(done, self.pings))
+        return self.estimate
+
+    def status(self, elapsed, pings_per_s, mb_per_s):
+        done = self.pingsDone()
+        eta = None
+        if self.pings is not None and done > 0 and self.started is not None:
+            eta = (self.pings - done) * (time.time() - self.started) / done
+        return {'stage': self.stage,
+                'pings_done': int(done),
+                'pings': self.pings,
+                'fraction': None if not self.pings else done / self.pings,
+                'tasks_done': self.tasks_done,
+                'tasks': self.tasks,
+                'pings_per_s': pings_per_s,
+                'read_mb_per_s': mb_per_s,
+                'eta_s': eta,
+                'elapsed_s': elapsed,
+                'rss_mb': Metrics()._rss() / 1024**2,
+                'updated': datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()}
+
+
+class ProgressReporter:
+    """
+    Context manager reporting the progress every interval seconds while it is open,
+    to the log and to the json file fname when given
+    """
+
+    def __init__(self, interval=60, fname=None):
+        self.interval = interval
+        self.fname = fname
+        self.callback = _Tasks(Progress())
+        self.done = threading.Event()
+
+    def _read(self):
+        _, read, _ = Metrics()._counters()
+        return read or 0
+
+    def report(self, state='running'):
+        now, read, done = time.time(), self._read(), Progress().pingsDone()
+        dt = max(now - self.last[0], 1e-9)
+        # A new run of the follower starts from 0 pings
+        status = Progress().status(now - self.t0, max(done - self.last[2], 0) / dt, (read - self.last[1]) / 1024**2 / dt)
+        status['state'] = state
+        self.last = (now, read, done)
+
+        eta = '-' if status['eta_s'] is None else str(datetime.timedelta(seconds=int(status['eta_s'])))
+        Log().info('Progress {}: {} / {} pings, {} / {} tasks, {:.0f} pings/s, {:.1f} MB/s read, ETA {}, memory {:.0f} MB'.format(
+            status['stage'], status['pings_done'], status['pings'] if status['pings'] is not None else '-',
+            status['tasks_done'], status['tasks'], status['pings_per_s'], status['read_mb_per_s'], eta, status['rss_mb']))
+
+        if self.fname is not None:
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(status, f, indent=1)
+            os.replace(tmp, self.fname)
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self.report()
+
+    def __enter__(self):
+        Progress().begin(None)
+        self.t0 = time.time()
+        self.last = (self.t0, self._read(), 0)
+        self.callback.register()
+        self.done.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.done.set()
+        self.thread.join()
+        self.callback.unregister()
+        self.report('failed' if value is not None else 'done')
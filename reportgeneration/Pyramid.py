@@ -0,0 +1,170 @@
+import os
+import numpy as np
+import xarray as xr
+import zarr
+from Logger import Logger as Log
+from Metrics import measure
+
+"""
+    Multiscale pyramid of the report
+
+    Level 0 is the report, each level below it halves Time and ChannelDepthUpper
+    until they are at most the size of the thumbnail. The value of a cell is the
+    mean sv of the cells it covers, nan counted as 0, so the Sa of a level, with
+    its thicker channels and longer bins, sums to the Sa of the report.
+    The levels are groups '1', '2', ... in <report>_pyramid.zarr, listed with
+    their sizes and factors in the root attributes.
+
+    The pyramid is updated from the first Time bin that changed, so a level only
+    recomputes its last bins from the level above it as windows are written and
+    pings are appended.
+"""
+
+# Size the levels stop at
+THUMBNAIL = {'Time': 256, 'ChannelDepthUpper': 64}
+# Time chunk of the levels
+LEVEL_CHUNK = 4096
+
+
+def pyramidName(fname):
+    """
+    The pyramid store of the report fname
+    """
+    return os.path.splitext(fname)[0] + '_pyramid.zarr'
+
+
+def _factors(sizes):
+    # Halving factors of the level below one with sizes
+    return {dim: 2 if sizes[dim] > n else 1 for dim, n in THUMBNAIL.items()}
+
+
+def _cover(n, step, index):
+    # Report bins, of n, covered by the bins at index of a level with step report bins per bin.
+    # Only the last bin can be short
+    return np.minimum(step, n - index * step)
+
+
+def coarsen(ds, factors, cover=None):
+    """
+    ds aggregated over factors[dim] bins along each dim, see the module description.
+    cover[dim] is the number of report bins each bin of ds covers along dim, all 1 for the report.
+    The value of a coarse bin is the mean over the report bins it covers, nan counted as 0.
+    The positions and times of a coarse bin are those of its first bin, the end positions
+    and ChannelDepthLower those of the last. The other variables are averaged.
+    """
+    windows = {dim: f for dim, f in factors.items() if f > 1}
+    first = {dim: np.arange(0, ds.sizes[dim], f) for dim, f in windows.items()}
+    last = {dim: np.minimum(first[dim] + f - 1, ds.sizes[dim] - 1) for dim, f in windows.items()}
+
+    weight, norm = 1, 1
+    for dim, f in windows.items():
+        w = xr.DataArray(np.ones(ds.sizes[dim]) if cover is None else cover[dim], dims=dim)
+        weight = weight * w
+        norm = norm * w.coarsen({dim: f}, boundary='pad').sum()
+    value = xr.DataArray(ds['value'].data, dims=ds['value'].dims)
+    total = (value * weight).coarsen(windows, boundary='pad').sum()
+    out = {'value': (total / norm).where(value.coarsen(windows, boundary='pad').count() > 0)}
+
+    for k in ds.data_vars:
+        if k != 'value':
+            dims = {dim: f for dim, f in windows.items() if dim in ds[k].dims}
+            out[k] = xr.DataArray(ds[k].data, dims=ds[k].dims).coarsen(dims, boundary='pad').mean() if dims else ds[k].variable
+
+    coords = {}
+    for k in ds.coords:
+        dims = [dim for dim in windows if dim in ds[k].dims]
+        index = last if k in ['Latitude2', 'Longitude2', 'ChannelDepthLower'] else first
+        coords[k] = ds[k].variable[{dim: index[dim] for dim in dims}]
+
+    return xr.Dataset({k: (v.dims, v.data) for k, v in out.items()}, coords=coords, attrs=ds.attrs)
+
+
+def _encoding(ds):
+    # The level keeps the time units of the report, the rest of the encoding is the default
+    for k in ds.variables:
+        ds[k].encoding = {e: v for e, v in ds[k].encoding.items() if e in ['units', 'calendar', 'dtype']} \
+            if 'units' in ds[k].encoding else {}
+    return ds
+
+
+def _writeTail(ds, path, group, index):
+    # ds into the level from Time index on, as Reportgenerator.appendZarr
+    n = zarr.open_group(path, mode='r')[group]['Time'].shape[0]
+    overlap = min(max(n - index, 0), ds.sizes['Time'])
+    if overlap > 0:
+        tail = ds.isel(Time=slice(0, overlap))
+        tail = tail.drop_vars([v for v in tail.variables if 'Time' not in tail[v].dims])
+        tail.to_zarr(path, group=group, mode='r+', region={'Time': slice(index, index + overlap)})
+    if overlap < ds.sizes['Time']:
+        ds.isel(Time=slice(overlap, None)).to_zarr(path, group=group, mode='a', append_dim='Time')
+
+
+@measure('pyramid')
+def updatePyramid(fname, start=0):
+    """
+    Bring the pyramid of the report fname up to date from Time index start on,
+    the first bin of the report that changed. start 0 rebuilds the pyramid.
+    """
+    path = pyramidName(fname)
+    if start == 0 or not os.path.exists(path):
+        start = 0
+        zarr.open_group(path, mode='w')
+    root = zarr.open_group(path, mode='a')
+
+    src = xr.open_zarr(fname)
+    sizes = dict(src.sizes)
+    # Report bins per bin of src
+    step = {dim: 1 for dim in THUMBNAIL}
+    levels = []
+    factors = _factors(src.sizes)
+    while any(f > 1 for f in factors.values()):
+        group = str(len(levels) + 1)
+
+        # The first coarse bin with a source bin that changed
+        c0 = start // factors['Time']
+        rebuild = c0 == 0 or group not in root or root[group].attrs.get('factors') != factors
+        if rebuild:
+            # New, or the level above it grew past the thumbnail
+            c0 = 0
+            src = src.chunk({'Time': LEVEL_CHUNK * factors['Time'], 'ChannelDepthUpper': -1})
+        else:
+            src = src.isel(Time=slice(c0 * factors['Time'], None))
+        cover = {'Time': _cover(sizes['Time'], step['Time'], np.arange(c0 * factors['Time'], c0 * factors['Time'] + src.sizes['Time'])),
+                 'ChannelDepthUpper': _cover(sizes['ChannelDepthUpper'], step['ChannelDepthUpper'], np.arange(src.sizes['ChannelDepthUpper']))}
+        ds = _encoding(coarsen(src, factors, cover))
+
+        if rebuild:
+            # Written chunk by chunk
+            ds.to_zarr(path, group=group, mode='w')
+        else:
+            _writeTail(ds.compute(), path, group, c0)
+        zarr.open_group(path, mode='a')[group].attrs['factors'] = factors
+
+        src = xr.open_zarr(path, group=group)
+        start = c0
+        step = {dim: step[dim] * factors[dim] for dim in step}
+        levels.append({'path': group, 'sizes': dict(src.sizes), 'factors': factors})
+        factors = _factors(src.sizes)
+
+    # Levels left from a longer report
+    for group in list(root.group_keys()):
+        if int(group) > len(levels):
+            del root[group]
+
+    root.attrs['levels'] = levels
+    zarr.consolidate_metadata(path)
+    Log().info('Pyramid of {} levels down to {} written to {}'.format(
+        len(levels), levels[-1]['sizes'] if levels else None, path))
+
+
+def openLevel(fname, width=None, height=None):
+    """
+    The coarsest level of the report fname with at least width Time bins and height channels,
+    the report itself when no level has. Only the attributes of the pyramid are read to choose it.
+    """
+    path = pyramidName(fname)
+    levels = zarr.open_group(path, mode='r').attrs.get('levels', []) if os.path.exists(path) else []
+    for level in reversed(levels):
+        if level['sizes']['Time'] >= (width or 0) and level['sizes']['ChannelDepthUpper'] >= (height or 0):
+            return xr.open_zarr(path, group=level['path'])
+    return xr.open_zarr(fname)
@@ -0,0 +1,268 @@
+import os
+import json
+import shutil
+import io
+import dask
+import numpy as np
+from xml.sax.saxutils import XMLGenerator
+from Logger import Logger as Log
+from Metrics import measure
+
+"""
+    Writers for the flat report formats
+
+    The report is converted a block of Time bins at a time, so the memory use is
+    set by the block size and not by the length of the survey. The global
+    attributes are written once, not repeated on every row.
+
+    csv     : one tidy file, as ds.to_dataframe()
+    parquet : a dataset directory partitioned by SaCategory, and optionally by day,
+              so readers only open the categories and days they filter on
+    xml     : ICES Acoustic, one Log element per Time bin, streamed to the file
+"""
+
+
+def blockSize(ds, rows=500000):
+    """
+    Time bins per block, so that a block flattens to about rows rows
+    """
+    cells = int(np.prod([n for dim, n in ds.sizes.items() if dim != 'Time']))
+    return max(1, rows // max(cells, 1))
+
+
+def timeBlocks(ds, time_chunk=None):
+    """
+    Yield ds computed a block of time_chunk Time bins at a time
+    """
+    time_chunk = blockSize(ds) if time_chunk is None else time_chunk
+    for i0 in range(0, ds.sizes['Time'], time_chunk):
+        yield ds.isel(Time=slice(i0, i0 + time_chunk)).compute()
+
+
+def _attrValue(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    return v
+
+
+def writeAttrs(attrs, fname):
+    """
+    The global attributes of the report as json
+    """
+    with open(fname, 'w') as f:
+        json.dump({k: _attrValue(v) for k, v in attrs.items()}, f, indent=2, default=str)
+
+
+@measure('csv')
+def writeCSV(ds, fname, time_chunk=None, attrs='sidecar'):
+    """
+    Write the report ds to a tidy csv file, one row per cell as ds.to_dataframe().
+    time_chunk : Time bins converted at a time, None keeps a block at about half a million rows
+    attrs      : 'sidecar' writes the attributes to fname with a .json extension,
+                 'header' writes them as '# key: value' lines at the top of the csv,
+                 read back with pandas.read_csv(fname, comment='#')
+    """
+    if attrs not in ['sidecar', 'header']:
+        raise ValueError('{} attribute output not defined'.format(attrs))
+
+    Log().info(f'Writing csv report to : {fname}')
+    with open(fname, 'w', newline='') as f:
+        if attrs == 'header':
+            for k, v in ds.attrs.items():
+                f.write('# {}: {}\n'.format(k, json.dumps(_attrValue(v), default=str)))
+
+        header = True
+        for block in timeBlocks(ds, time_chunk):
+            block.to_dataframe().to_csv(f, header=header, index=True)
+            header = False
+
+    if attrs == 'sidecar':
+        writeAttrs(ds.attrs, os.path.splitext(fname)[0] + '.json')
+
+
+def _frame(block, drop_zeros=False, by_day=False):
+    """
+    Long format table of a block, with the strings as categoricals
+    """
+    df = block.to_dataframe().reset_index()
+    if drop_zeros:
+        df = df[df['value'].fillna(0) != 0]
+    if by_day:
+        df['Day'] = df['Time'].dt.strftime('%Y-%m-%d')
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype('category')
+    return df
+
+
+@measure('parquet')
+def writeParquet(ds, path, time_chunk=None, by_day=False, drop_zeros=False):
+    """
+    Write the report ds to a parquet dataset in the directory path, partitioned
+    as path/SaCategory=<cat>/[Day=<yyyy-mm-dd>/]. The blocks of Time bins are
+    written in parallel on the dask scheduler, each to its own files.
+    The string columns are dictionary encoded, Time is stored in microseconds,
+    which all parquet readers support. The attributes go to path/_attrs.json,
+    which dataset readers skip.
+    time_chunk : Time bins converted at a time, None keeps a block at about half a million rows
+    by_day     : Also partition by the day of Time
+    drop_zeros : Leave out the cells without Sa, where value is 0 or nan
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    Log().info(f'Writing parquet report to : {path}')
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    partition_cols = ['SaCategory'] + (['Day'] if by_day else [])
+
+    def write(block):
+        df = _frame(block, drop_zeros, by_day)
+        if len(df) > 0:
+            pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), path,
+                                partition_cols=partition_cols,
+                                coerce_timestamps='us', allow_truncated_timestamps=True)
+        return len(df)
+
+    time_chunk = blockSize(ds) if time_chunk is None else time_chunk
+    writes = [dask.delayed(write)(ds.isel(Time=slice(i0, i0 + time_chunk)))
+              for i0 in range(0, ds.sizes['Time'], time_chunk)]
+    rows = sum(dask.compute(*writes))
+
+    writeAttrs(ds.attrs, os.path.join(path, '_attrs.json'))
+    Log().info(f'{rows} rows written to {path}')
+
+
+class _XMLWriter:
+    """
+    Indented elements on an incremental XML writer, nothing is kept once written
+    """
+    def __init__(self, out, level=0):
+        self.gen = XMLGenerator(out, 'utf-8', short_empty_elements=True)
+        self.level = level
+        # The root element follows the xml declaration on its own line
+        self.newline = level > 0
+
+    def _indent(self):
+        if self.newline:
+            self.gen.ignorableWhitespace('\n' + '  ' * self.level)
+        self.newline = True
+
+    def start(self, name, attrs=None):
+        self._indent()
+        self.gen.startElement(name, attrs or {})
+        self.level += 1
+
+    def end(self, name):
+        self.level -= 1
+        self._indent()
+        self.gen.endElement(name)
+
+    def element(self, name, text=None, idref=None):
+        self._indent()
+        self.gen.startElement(name, {} if idref is None else {'IDREF': idref})
+        if text is not None:
+            self.gen.characters(text)
+        self.gen.endElement(name)
+
+
+def _number(x):
+    return None if np.isnan(x) else repr(float(x))
+
+
+def _icesLogs(block, attrs, sv_threshold=None):
+    """
+    The Log elements of a block of Time bins, as text. Only the cells with Sa are written.
+    """
+    out = io.StringIO()
+    w = _XMLWriter(out, level=2)
+
+    value = block['value'].transpose('Time', 'ChannelDepthUpper', 'SaCategory').values
+    upper = block['ChannelDepthUpper'].values
+    lower = block['ChannelDepthLower'].values
+    categories = block['SaCategory'].values
+    times = np.datetime_as_string(block['Time'].values, unit='s')
+    per_log = {k: block[k].values for k in ['Distance', 'Latitude', 'Longitude', 'Latitude2', 'Longitude2',
+                                           'Origin', 'Origin2', 'Validity', 'BottomDepth'] if k in block}
+    has_sa = np.nan_to_num(value) != 0
+
+    for i in range(value.shape[0]):
+        w.start('Log')
+        w.element('Distance', _number(per_log['Distance'][i]))
+        w.element('Time', times[i].replace('T', ' '))
+        for k in ['Latitude', 'Longitude']:
+            w.element(k, _number(per_log[k][i]))
+        w.element('Origin', idref='AC_LogOrigin_' + str(per_log['Origin'][i]))
+        # The last bin of the survey has no end position
+        for k in ['Latitude2', 'Longitude2']:
+            if not np.isnan(per_log[k][i]):
+                w.element(k, _number(per_log[k][i]))
+        w.element('Origin2', idref='AC_LogOrigin_' + str(per_log['Origin2'][i]))
+        w.element('Validity', idref='AC_LogValidity_' + str(per_log['Validity'][i]))
+        if 'BottomDepth' in per_log and not np.isnan(per_log['BottomDepth'][i]):
+            w.element('BottomDepth', _number(per_log['BottomDepth'][i]))
+
+        for j in np.flatnonzero(has_sa[i].any(axis=1)):
+            w.start('Sample')
+            w.element('ChannelDepthUpper', _number(upper[j]))
+            if not np.isnan(lower[j]):
+                w.element('ChannelDepthLower', _number(lower[j]))
+            w.element('PingAxisInterval', str(attrs['PingAxisInterval']))
+            w.element('PingAxisIntervalType', idref='AC_PingAxisIntervalType_' + str(attrs['PingAxisIntervalType']))
+            w.element('PingAxisIntervalUnit', idref='AC_PingAxisIntervalUnit_' + str(attrs['PingAxisIntervalUnit']))
+            if sv_threshold is not None:
+                w.element('SvThreshold', str(sv_threshold))
+            w.element('PingAxisIntervalOrigin', idref='AC_PingAxisIntervalOrigin_' + str(attrs['PingAxisIntervalOrigin']))
+            for k in np.flatnonzero(has_sa[i, j]):
+                w.start('Data')
+                w.element('SaCategory', idref='SaCategory_' + str(categories[k]))
+                w.element('Type', idref='AC_AcousticDataType_' + str(attrs.get('Type', 'C')))
+                w.element('Unit', idref='AC_DataUnit_' + str(attrs.get('Unit', 'm2nmi-2')))
+                w.element('Value', _number(value[i, j, k]))
+                w.end('Data')
+            w.end('Sample')
+        w.end('Log')
+
+    return out.getvalue()
+
+
+@measure('ices xml')
+def writeICESAcoustic(ds, fname, sv_threshold=None, time_chunk=None, parallel=None):
+    """
+    Write the report ds, with value in the unit of ds.attrs['Unit'], to ICES Acoustic XML.
+    Blocks of Time bins are rendered as dask tasks, parallel blocks at a time, and
+    written to the file in order. Only the Sa cells that are not 0 or nan are written.
+    Threads share the interpreter lock here, the processes or distributed scheduler
+    render the blocks in parallel.
+    sv_threshold : SvThreshold of the Samples, left out when None
+    time_chunk   : Time bins per block, None keeps a block at about half a million cells
+    parallel     : Blocks rendered at a time, the dask number of workers or the number of cores by default
+    """
+    Log().info(f'Writing ICES Acoustic report to : {fname}')
+
+    time_chunk = blockSize(ds) if time_chunk is None else time_chunk
+    parallel = parallel or dask.config.get('num_workers', None) or os.cpu_count()
+    attrs = ds.attrs
+    starts = list(range(0, ds.sizes['Time'], time_chunk))
+
+    with open(fname, 'w', encoding='utf-8') as f:
+        w = _XMLWriter(f)
+        w.gen.startDocument()
+        w.start('Acoustic')
+        w.start('Cruise')
+        w.element('Platform', idref='AC_Platform_' + str(attrs.get('Platform', 'NaN')))
+        w.element('LocalID', str(attrs.get('LocalID', 'NaN')))
+
+        for b0 in range(0, len(starts), parallel):
+            logs = [dask.delayed(_icesLogs)(ds.isel(Time=slice(i0, i0 + time_chunk)), attrs, sv_threshold)
+                    for i0 in starts[b0:b0 + parallel]]
+            for text in dask.compute(*logs):
+                f.write(text)
+
+        w.end('Cruise')
+        w.end('Acoustic')
+        f.write('\n')
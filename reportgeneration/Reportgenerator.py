@@ -1,116 +1,252 @@
 import xarray as xr
-import shutil
-from numcodecs import Blosc
+import zarr
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import os
 import dask
 import datetime
+from functools import partial
+from contextlib import nullcontext
 from Logger import Logger as Log
 from reportgeneration.EKGridder import EKGridder
 from pathlib import Path
-from Resources import Resources as Res
+from WeightCache import WeightCache
+from Encoding import PROFILES, encoding, timeChunk
+from ReportWriter import writeCSV, writeParquet, writeICESAcoustic
+from Echogram import saveEchograms, saveIntegrationImages
+from Pyramid import updatePyramid
+from Metrics import Metrics, Instrument, measure
+from Progress import Progress, ProgressReporter
+from Scheduler import Scheduler, addSchedulerArguments
+
+
+def _bottomIndex(bottom):
+    """
+    Index of the bottom in each ping of a (ping, range) block of bottom_range
+    """
+    # Replace nan with 0, bottom and subbottom is 1
+    bottom = (~np.isnan(bottom)).astype(np.int8)
+
+    # Diff in range direction gives 1 at bottom
+    return np.diff(bottom, axis=1).argmax(1)
+
+
+def _shiftRange(sv, offset):
+    """
+    Shift each ping along range (last axis) by its own offset, as xarray shift(range=offset).
+    Samples shifted in from outside the range are NaN.
+    """
+    n = sv.shape[-1]
+    idx = np.arange(n) - offset
+    shifted = np.take_along_axis(sv, np.clip(idx, 0, n - 1), axis=-1)
+    return np.where((idx >= 0) & (idx < n), shifted, np.nan)
 
 
 class Reportgenerator:
 
-    def __init__(self, grid_fname=None, pred_fname=None, bot_fname=None, out_fname=None, freq=38000, SvThreshold=-100, vtype='range', vstep=50,PingAxisIntervalOrigin='start', htype='ping', hstep=50, ChannelDepthStart=0, ChannelDepthEnd=500, commit_sha='NA'):
+    @measure('setup')
+    def __init__(self, grid_fname=None, pred_fname=None, bot_fname=None, out_fname=None, freq=38000, SvThreshold=-100, vtype='range', vstep=50,PingAxisIntervalOrigin='start', htype='ping', hstep=50, ChannelDepthStart=0, ChannelDepthEnd=500, commit_sha='NA', fused=True, engine='matmul', window=None, end_time=None, profile='default', pyramid=False):
         Log().info('####### Reportgenerator ########')
+        Progress().setStage('setup')
         self.vtype = vtype
         self.vstep = vstep
         self.htype = htype
         self.hstep = hstep
         self.commit_sha = commit_sha
+        self.SvThreshold = SvThreshold
         self.PingAxisIntervalOrigin = PingAxisIntervalOrigin
         self.out_fname = out_fname
-        Res().setTmpDir(str(Path(self.out_fname).parent) + os.sep + 'tmp')
-        zarr_grid = xr.open_zarr(grid_fname, chunks={'frequency': 'auto', 'ping_time': 'auto', 'range': -1})
-        zarr_grid = zarr_grid.drop_vars(['angle_alongship', 'angle_athwartship'])
-        zarr_grid_attrs = zarr_grid.attrs
-        zarr_grid_attrs["filename"] = grid_fname
-        self.zarr_sv_attrs = zarr_grid_attrs
-
-        zarr_pred = xr.open_zarr(pred_fname)
-        zarr_pred_attrs = zarr_pred.attrs
-        zarr_pred_attrs["filename"] = pred_fname
-        self.zarr_labels_attrs = zarr_pred_attrs
+        # Number of Time bins gridded at a time, None grids the whole survey in one graph
+        self.window = window
+        # Named encoding of the report store, see Encoding
+        if profile not in PROFILES:
+            raise ValueError('{} encoding profile not defined'.format(profile))
+        self.profile = profile
+        # Also keep the multiscale pyramid of the report up to date, see Pyramid
+        self.pyramid = pyramid
+        with Metrics().stage('open inputs'):
+            zarr_grid = xr.open_zarr(grid_fname, chunks={'frequency': 'auto', 'ping_time': 'auto', 'range': -1})
+            zarr_grid = zarr_grid.drop_vars(['angle_alongship', 'angle_athwartship'])
+            zarr_grid_attrs = zarr_grid.attrs
+            zarr_grid_attrs["filename"] = grid_fname
+            self.zarr_sv_attrs = zarr_grid_attrs
+
+            zarr_pred = xr.open_zarr(pred_fname)
+            zarr_pred_attrs = zarr_pred.attrs
+            zarr_pred_attrs["filename"] = pred_fname
+            self.zarr_labels_attrs = zarr_pred_attrs
         
-        if bot_fname is None:
-            zarr_bot = None
-            self.zarr_bot_attrs = None
+            if bot_fname is None:
+                zarr_bot = None
+                self.zarr_bot_attrs = None
 
-        else:
-            zarr_bot = xr.open_zarr(bot_fname)
-            zarr_bot_attrs = zarr_bot.attrs
-            zarr_bot_attrs["filename"] = bot_fname
-            self.zarr_bot_attrs = zarr_bot_attrs
+            else:
+                zarr_bot = xr.open_zarr(bot_fname)
+                zarr_bot_attrs = zarr_bot.attrs
+                zarr_bot_attrs["filename"] = bot_fname
+                self.zarr_bot_attrs = zarr_bot_attrs
+
+        if end_time is not None:
+            # Inputs that are still being written, only the pings that are in all of them
+            inputs = [zarr_grid, zarr_pred] + ([] if zarr_bot is None else [zarr_bot])
+            end_time = min([np.datetime64(end_time)] + [z['ping_time'].values[-1] for z in inputs])
+            zarr_grid = zarr_grid.sel(ping_time=slice(None, end_time))
+            zarr_pred = zarr_pred.sel(ping_time=slice(None, end_time))
+            if zarr_bot is not None:
+                zarr_bot = zarr_bot.sel(ping_time=slice(None, end_time))
 
         self.has_out_file = False
-        # If there is a output file, start griding after last timestamp in file
+        self.ds = None
+        origin = None
+        draft = None
+        # If there is a output file, continue the grid from the bins that can still change
         if out_fname is not None and os.path.exists(out_fname):
 
-            Log().info('Existing file found, trying to append')
-            self.has_out_file = True
             zarr_out = xr.open_zarr(out_fname)
-            start_time = zarr_out['Time'].values[-1]
-            stop_time = zarr_grid['ping_time'].values[-1]
-            zarr_grid = zarr_grid.sel(ping_time=slice(start_time, stop_time))
-            zarr_pred = zarr_pred.sel(ping_time=slice(start_time, stop_time))
-            zarr_bot = zarr_bot.sel(ping_time=slice(start_time, stop_time))
-
-            Log().info(
-                'Existing output file time span: \nt0={}\nt1={}'.format(zarr_out['Time'].values[0], start_time))
-            Log().info('Got new data spanning:\nt0={}\nt1={}'.format(zarr_grid['ping_time'].values[0], stop_time))
+            state = zarr_out.attrs
+            if 'ResumeTime' not in state:
+                Log().warning('Existing file has no append state, starting new outputfile')
+            else:
+                Log().info('Existing file found, trying to append')
+                self.has_out_file = True
+
+                # The first bin is an edge bin, it is regridded but not written
+                origin = {'bin': state['ResumeBin'] - 1,
+                          'ping': state['ResumePing'],
+                          'time': np.datetime64(state['GridStartTime']),
+                          'distance': state['GridStartDistance']}
+                draft = state['TransducerDraft']
+
+                # Report index of the first bin that is written, bin 0 is not in the report
+                self.tail_index = state['ResumeBin'] - 1
+
+                start_time = np.datetime64(state['ResumeTime'])
+                zarr_grid = zarr_grid.sel(ping_time=slice(start_time, None))
+                zarr_pred = zarr_pred.sel(ping_time=slice(start_time, None))
+                if zarr_bot is not None:
+                    zarr_bot = zarr_bot.sel(ping_time=slice(start_time, None))
+
+                Log().info(
+                    'Existing output file time span: \nt0={}\nt1={}'.format(zarr_out['Time'].values[0], zarr_out['Time'].values[-1]))
+                Log().info('Got new data spanning:\nt0={}\nt1={}'.format(state['LastPingTime'], zarr_grid['ping_time'].values[-1]))
+
+                if zarr_grid['ping_time'].values[-1] <= np.datetime64(state['LastPingTime']):
+                    Log().info('No new pings since the last report')
+                    self.worker_data = None
+                    self.gridders = None
+                    return
         else:
             Log().info('Starting new outputfile')
 
+        # Lazy, one value per ping
         bottomRange = self.extractRangeToBottom(zarr_bot)
-        bottomRange = xr.DataArray(bottomRange, coords={'time': (['time'], zarr_pred.ping_time.values)},
-                                   dims=['time'])
-        bottomDepth = None
+        BottomDepth = None
         self.worker_data = []
+        self.gridders = []
 
-        for cat in zarr_pred["annotation"]["category"]:
+        # Values below the threshold do not contribute, the same for all categories
+        with Metrics().stage('threshold'):
+            zarr_grid['sv'] = xr.where(zarr_grid['sv'] < np.power(10, SvThreshold/10), 0, zarr_grid['sv'])
 
-            zarr_grid = xr.where(zarr_grid < np.power(10, SvThreshold/10), 0, zarr_grid)
+        if fused:
+            # All categories are stacked and gridded in one pass over Sv
+            categories = [None]
+        else:
+            categories = zarr_pred["annotation"]["category"]
+
+        for cat in categories:
 
             masked_sv = self.applyMask(zarr_grid, zarr_pred, cat=cat, freq=freq)
 
             if vtype == 'depth':
                 masked_sv = self.rangeToDepthCorrection(masked_sv)
-                if bottomDepth is None:
-                    bottomRange += (masked_sv['transducer_draft'] + masked_sv['heave']).values
-                # Range is now depth
-                masked_sv['range'] = masked_sv['range'] + masked_sv['transducer_draft'][0].values
-
-            ekgridder = EKGridder(masked_sv, vtype, vstep, PingAxisIntervalOrigin, htype, hstep, ChannelDepthStart, ChannelDepthEnd)
+                if BottomDepth is None and bottomRange is not None:
+                    bottomRange = bottomRange + (masked_sv['transducer_draft'] + masked_sv['heave']).data
+                # Range is now depth, with the draft at the start of the survey
+                if draft is None:
+                    draft = float(masked_sv['transducer_draft'][0].values)
+                masked_sv['range'] = masked_sv['range'] + draft
+
+            ekgridder = EKGridder(masked_sv, vtype, vstep, PingAxisIntervalOrigin, htype, hstep, ChannelDepthStart, ChannelDepthEnd, engine, origin)
             if ekgridder.target_h_bins.shape[0] <= 2:
                 self.worker_data = None
+                self.gridders = None
                 Log().info('Not enough data to make a grid.')
                 break
 
-            Log().info(f'Gridding category: {cat.values.flatten()[0]}')
-
-            if bottomDepth is None:
-                BottomDepth = bottomRange.groupby_bins('time', ekgridder.ping_time).mean()
-
-            rg = ekgridder.regrid()
-
-            if vtype == 'depth':
-                rg = rg.rename({'range': 'depth'})
+            if cat is None:
+                Log().info(f'Gridding categories: {zarr_pred["category"].values.tolist()}')
+            else:
+                Log().info(f'Gridding category: {cat.values.flatten()[0]}')
+
+            if BottomDepth is None:
+                BottomDepth = self.binnedMean(bottomRange, zarr_pred.ping_time.values, ekgridder.ping_time)
+                self.BottomDepth = BottomDepth
+                self.state = self.gridState(ekgridder, draft)
+
+            self.gridders.append((cat, ekgridder))
+            if window is None:
+                # Else gridded window by window when saved, see gridWindows
+                self.worker_data.append(self.categoryGridd(cat, ekgridder.regrid(), BottomDepth))
+
+        if self.gridders:
+            ekgridder = self.gridders[0][1]
+            Metrics().annotate(pings=len(ekgridder.source_h_bins), time_bins=len(ekgridder.target_h_bins),
+                               channels=len(ekgridder.target_v_bins), categories=int(zarr_pred['category'].size),
+                               window=window, fused=fused, engine=engine)
+            Progress().begin(len(ekgridder.source_h_bins))
+
+    def categoryGridd(self, cat, rg, BottomDepth):
+        """
+        Label the grid of a category, or of all categories when cat is None
+        """
+        if self.vtype == 'depth':
+            rg = rg.rename({'range': 'depth'})
 
+        if cat is not None:
             rg = rg.assign_coords(category=[cat])
-            rg = rg.assign_coords(BottomDepth=("ping_time", np.append(BottomDepth.values, np.NaN)))
-            self.worker_data.append(rg)
-
-        self.ds = None
+        return rg.assign_coords(BottomDepth=("ping_time", BottomDepth))
 
-    def rangeToDepthCorrection_(self, masked_sv):
+    @measure('grid state')
+    def gridState(self, ekgridder, draft):
+        """
+        Where the next append continues the grid, stored in the report attributes.
+        The last bin of the report and the bins sharing a source ping with the last
+        ping can still change with new pings. The next append regrids them from
+        the ping before the first ping they overlap, everything before is final.
+        """
+        W, _ = ekgridder._splitWeight(ekgridder._weight(ekgridder.target_h_bins.values, ekgridder.source_h_bins.values))
+        origin = ekgridder.origin
+        ping_time = ekgridder.data['ping_time'].values
+
+        # The last bin is an edge bin, the second last is the last one in the report
+        last = W.shape[0] - 2
+        shared = W[:, -1].nonzero()[0]
+        resume = max(min(shared.min(), last) if len(shared) else last, 1)
+
+        pings = W.indices[W.indptr[resume]:W.indptr[resume + 1]]
+        ping = max(pings.min() - 1, 0) if len(pings) else len(ping_time) - 1
+
+        return {'ResumeBin': int(origin['bin'] + resume),
+                'ResumePing': int(origin['ping'] + ping),
+                'ResumeTime': str(ping_time[ping]),
+                'LastPingTime': str(ping_time[-1]),
+                'GridStartTime': str(origin['time']),
+                'GridStartDistance': float(origin['distance']),
+                'TransducerDraft': draft}
+
+    @measure('depth correction')
+    def rangeToDepthCorrection(self, masked_sv):
+        """
+        Shift every ping down by its transducer draft + heave, rounded to whole range samples.
+        Each ping chunk is shifted in one gather with its own vector of offsets, so the
+        offsets are never computed up front and the graph gets a single layer no matter
+        how many unique offsets there are.
+        """
 
         dr = masked_sv['range'].diff('range')[0].values
         ridx = (masked_sv['transducer_draft']+masked_sv['heave'])/dr
-        ridx = xr.DataArray.round(ridx).astype(int).data
+        ridx = xr.DataArray.round(ridx).astype(int)
 
         """
         # Debug check echogram before heav and draft compensated
@@ -119,13 +255,13 @@ class Reportgenerator:
         plt.axis('auto')
         """
 
-        for offset in np.unique(ridx.compute()):
-            colidx = dask.array.argwhere(ridx == offset)
-            colidx = colidx.compute().flatten()
+        # One offset per ping, chunked like sv and broadcast over the other axes
+        sv = masked_sv['sv']
+        axis = sv.get_axis_num('ping_time')
+        offset = ridx.chunk({'ping_time': sv.chunks[axis]}).data
+        offset = offset[tuple(slice(None) if i == axis else None for i in range(sv.ndim))]
 
-            # This is a bottleneck. How to speed up?
-            # Try to use storage, see ZarrGridder
-            masked_sv['sv'][colidx, :] = masked_sv['sv'][colidx, :].shift(range=offset)
+        masked_sv['sv'].data = dask.array.map_blocks(_shiftRange, sv.data, offset, dtype=sv.dtype)
 
         """
         # Debug check echogram after heav and draft compensated
@@ -137,60 +273,78 @@ class Reportgenerator:
         """
         return masked_sv
 
-    def rangeToDepthCorrection(self, masked_sv):
-
-        dr = masked_sv['range'].diff('range')[0].values
-        ridx = (masked_sv['transducer_draft']+masked_sv['heave'])/dr
-        ridx = xr.DataArray.round(ridx).astype(int).data
-
+    @measure('bottom')
+    def extractRangeToBottom(self, bot):
         """
-        # Debug check echogram before heav and draft compensated
-        plt.figure()
-        plt.imshow(10 * np.log10(masked_sv['sv'][0:1000,:].transpose().values + 10e-20), vmin=-80,vmax=-20, origin='upper')
-        plt.axis('auto')
+        Range to the bottom for every ping, as a lazy 1-D dask array.
+        Each ping chunk is reduced on its own, so the pings x range bottom
+        mask is never held in memory. None if there is no bottom data.
         """
+        if bot is None:
+            return None
 
-        depth_masked_sv = masked_sv.copy()
-        for offset in np.unique(ridx.compute()):
-            colidx = dask.array.argwhere(ridx == offset)
-            colidx = colidx.compute().flatten()
+        bottom = bot['bottom_range'].transpose('ping_time', 'range').data
+        bottom = bottom.rechunk({1: -1})
 
-            # This is a bottleneck. How to speed up?
-            # Try to use storage, see ZarrGridder
-            depth_masked_sv['sv'][colidx, :] = masked_sv['sv'][colidx, :].shift(range=offset)
+        # Find index of bottom
+        botIdx = dask.array.map_blocks(_bottomIndex, bottom, drop_axis=1, dtype=int)
 
-        masked_sv = depth_masked_sv
+        # Find range to bottom, the diff in range direction is labeled with the upper range
+        return botIdx.map_blocks(partial(np.take, bot['range'].values[1:]), dtype=bot['range'].dtype)
 
+    @measure('bottom depth')
+    def binnedMean(self, values, time, edges):
         """
-        # Debug check echogram after heav and draft compensated
-        plt.figure()
-        plt.imshow(10 * np.log10(masked_sv['sv'][0:1000, :].transpose().values + 10e-20), vmin=-80, vmax=-20,
-                   origin='upper')
-        plt.axis('auto')
-        plt.show()
+        Mean of values (one per ping at time) in the time bins (edges[i], edges[i+1]],
+        one value per horizontal bin. Same numbers as groupby_bins(...).mean(), but lazy:
+        the pings are assigned to their bin segment and reduced with bincount per chunk.
+        The last bin, and bins without pings, are NaN.
         """
-        return masked_sv
-
-    def extractRangeToBottom(self, bot):
+        n = len(edges)
+        if values is None:
+            return np.full(n, np.nan)
 
-        # Replace nan with 0, bottom and subbottom is 1
-        bot['bottom_range'] = xr.where(bot['bottom_range'].isnull(), 0, 1)
+        values = dask.array.asarray(values)
 
-        # Diff in range direction gives 1 at bottom
-        bot_ = bot['bottom_range'].diff(dim='range')
+        # Pings outside the bins go to the last (NaN) bin
+        segment = np.searchsorted(edges, time, side='left') - 1
+        segment[(segment < 0) | (segment >= n - 1)] = n - 1
+        segment = dask.array.from_array(segment, chunks=values.chunks)
 
-        # Find index of bottom
-        botIdx = bot_.data.argmax(1)
-
-        # Find range to bottom
-        range = bot_['range'].isel(range=botIdx)
+        valid = ~dask.array.isnan(values)
+        sums = dask.array.bincount(segment, weights=dask.array.where(valid, values, 0), minlength=n)
+        counts = dask.array.bincount(segment, weights=valid, minlength=n)
 
-        return range.values
+        mean = dask.array.where(counts > 0, sums / dask.array.maximum(counts, 1), np.nan)
+        return dask.array.where(np.arange(n) < n - 1, mean, np.nan)
 
+    @measure('mask')
     def applyMask(self, data=None, pred=None, cat=None, freq=38000):
+        """
+        Mask Sv with the annotation of category cat.
+        If cat is None, all category masks are stacked along a category axis and
+        Sv is multiplied with all of them at once.
+        """
 
         fdata = data.sel(frequency=freq)
 
+        if cat is None:
+            mask = pred["annotation"]
+            mask = xr.where((mask['category'] < 0) & (mask < 0), 1, mask)
+            mask = mask.transpose('category', 'ping_time', 'range')
+
+            # Keep the blocks about the size of the Sv chunks, with all categories in each block
+            sv = fdata['sv'].data
+            pchunk = max(1, max(sv.chunks[0]) // mask.sizes['category'])
+            sv = sv.rechunk({0: pchunk})
+            mask = mask.data.rechunk({0: -1, 1: pchunk, 2: sv.chunks[1]})
+
+            masked_sv = sv[None, :, :] * mask
+
+            fdata = fdata.assign_coords(category=pred['category'].values)
+            fdata['sv'] = (('category', 'ping_time', 'range'), masked_sv)
+            return fdata
+
         mask = pred["annotation"].sel(category=cat.values)
         if cat.values.flatten()[0] < 0:
             mask = xr.where(mask < 0, 1, mask)
@@ -209,35 +363,81 @@ class Reportgenerator:
         return fdata
 
 
-    def getGridd(self):
+    def gridWindows(self):
+        """
+        The report in windows of self.window Time bins, formatted as getGridd,
+        with the number of source pings the window adds to the previous ones.
+        Each window only depends on the source pings of its bins, so it can be
+        computed, written and released before the next one is gridded.
+        """
+        ekgridder = self.gridders[0][1]
+
+        # The first and last Time bin are edge bins, dropped as in getGridd
+        windows = ekgridder.windows(self.window, 1, len(ekgridder.target_h_bins) - 1)
+
+        # One value per Time bin, small enough to keep for the whole survey
+        coords = [gridder.gridCoords().compute() for _, gridder in self.gridders]
+        BottomDepth = dask.array.asarray(self.BottomDepth).compute()
+        latitude = coords[0]['latitude'].values
+        longitude = coords[0]['longitude'].values
+
+        last = 0
+        for i, window in enumerate(windows):
+            b0, b1, _, p1 = window
+            # The last window takes the pings after the last bin
+            p1 = len(ekgridder.source_h_bins) if i == len(windows) - 1 else max(p1, last)
+            pings, last = p1 - last, p1
+
+            data = [self.categoryGridd(cat, gridder.regridWindow(window, c), BottomDepth[b0:b1])
+                    for (cat, gridder), c in zip(self.gridders, coords)]
+            ds = xr.concat(data, dim='category')
+
+            r0 = ds[self.vtype].values[0]
+            r1 = ds[self.vtype].values[-2]
+            ds = ds.sel({self.vtype: slice(r0, r1)})
+
+            # The next bin closes the last bin of the window, except at the end of the survey
+            end = None if i == len(windows) - 1 else (latitude[b1], longitude[b1])
+            yield pings, self.formatToRapport(ds, end)
+
+    @measure('write windows')
+    def writeWindows(self, fname, append=False):
+        """
+        Grid and write the report to zarr one window at a time, see gridWindows.
+        With append the windows go into the existing report fname, see appendZarr.
+        """
+        index = self.tail_index if append else 0
+        for pings, ds in self.gridWindows():
+            with Progress().step('window', pings):
+                with Metrics().stage('compute window'):
+                    ds = ds.compute()
+                if append:
+                    self.appendZarr(ds, fname, index)
+                else:
+                    # One window per chunk along Time, unless the profile sets the chunks
+                    chunks = {'Time': timeChunk(self.profile, self.window)}
+                    Log().info(f'Writing gridded data to : {fname}')
+                    ds.to_zarr(fname, mode='w', encoding=encoding(ds, self.profile, chunks))
+                    append = True
+                if self.pyramid:
+                    updatePyramid(fname, index)
+            index += ds.sizes['Time']
+            Log().info(f'Time {ds["Time"].values[0]} - {ds["Time"].values[-1]} written')
+        Log().info(f'Done writing file {fname}')
 
+    def getGridd(self):
+        """
+        The report as one lazy dataset, nothing is computed until it is saved
+        """
         if self.ds is None and self.worker_data is not None:
 
-            # Hack to avoid crash when we save final grid
-            # Store grid for each category
-            # Then reload and concatenate
-
-            # Ensure tmp directory exists
-            tmp_path_name = Res().getTmpDir() + os.sep + '__tmp_main_out'
-
-            if not os.path.exists(tmp_path_name):
-                os.makedirs(tmp_path_name)
-
-            # Store each category
-            fnames = []
-            for d in self.worker_data:
-                fname = tmp_path_name+os.sep+f'gridd_{d["category"].values[0]}.zarr'
-                fnames.append(fname)
-                d.to_zarr(fnames[-1], mode='w',safe_chunks=False)
-
-            # Reload and concatenate
-            self.worker_data = []
-            for fname in fnames:
-                d = xr.open_zarr(fname)
-                self.worker_data.append(d)
-            #### End hack
+            if self.window is None:
+                data = self.worker_data
+            else:
+                # Not streamed, the whole survey in one graph
+                data = [self.categoryGridd(cat, gridder.regrid(), self.BottomDepth) for cat, gridder in self.gridders]
 
-            self.ds = xr.concat(self.worker_data, dim='category')
+            self.ds = xr.concat(data, dim='category')
 
             r0 = self.ds[self.vtype].values[0]
             r1 = self.ds[self.vtype].values[-2]
@@ -245,11 +445,18 @@ class Reportgenerator:
 
             self.ds = self.ds.isel(ping_time=slice(1, len(self.ds['ping_time']) - 1))
 
+            # Dropping the edge bin leaves a short first chunk, zarr needs uniform chunks
+            sv = self.ds['sv']
+            self.ds = self.ds.chunk({'ping_time': max(sv.chunks[sv.get_axis_num('ping_time')])})
+
             self.ds = self.formatToRapport(self.ds)
 
         return self.ds
 
-    def formatToRapport(self, ds):
+    def formatToRapport(self, ds, end=None):
+        """
+        end : (latitude, longitude) at the end of the last bin, when ds is a window of a longer grid
+        """
 
         if 'range' in ds.coords:
             range_or_depth = 'range'
@@ -265,8 +472,9 @@ class Reportgenerator:
 
         # Add new coordinates
         N = len(ds.Time)
-        Latitude2 = np.append(ds.Latitude[1:].values, np.NaN)  # Adress end point
-        Longitude2 = np.append(ds.Longitude[1:].values, np.NaN)  # Address last point
+        end = (np.NaN, np.NaN) if end is None else end
+        Latitude2 = np.append(ds.Latitude[1:].values, end[0])  # Adress end point
+        Longitude2 = np.append(ds.Longitude[1:].values, end[1])  # Address last point
         Origin = np.repeat("start", N)
         Origin2 = np.repeat("end", N)
         Validity = np.repeat("V", N)
@@ -320,30 +528,124 @@ class Reportgenerator:
             "source_filenames_labels": str(self.zarr_labels_attrs),
             "source_filenames_bottom": str(self.zarr_bot_attrs),
             "source_filenames_sv": str(self.zarr_sv_attrs)})
+
+        # Where the next append continues
+        ds = ds.assign_attrs(self.state)
         return ds
 
+    @measure('append')
+    def appendZarr(self, ds, fname, index):
+        """
+        Write ds into the report fname from Time index on, a chunk at a time.
+        Bins already in the report are overwritten in place, the rest is appended.
+        """
+        store = zarr.open_group(fname, mode='r')
+        n = store['Time'].shape[0]
+        step = store['value'].chunks[xr.open_zarr(fname)['value'].dims.index('Time')]
+
+        for i0 in range(0, ds.sizes['Time'], step):
+            part = ds.isel(Time=slice(i0, i0 + step))
+            # The pings of the run in proportion to the bins, when not a window of writeWindows
+            with Progress().step('append', (Progress().pings or 0) * part.sizes['Time'] / ds.sizes['Time']):
+                part = part.compute()
+                i = index + i0
+                overlap = min(max(n - i, 0), part.sizes['Time'])
+
+                if overlap > 0:
+                    # Only the variables along Time are written to a region
+                    tail = part.isel(Time=slice(0, overlap))
+                    tail = tail.drop_vars([v for v in tail.variables if 'Time' not in tail[v].dims])
+                    tail.to_zarr(fname, mode='r+', region={'Time': slice(i, i + overlap)})
+
+                if overlap < part.sizes['Time']:
+                    part.isel(Time=slice(overlap, None)).to_zarr(fname, mode='a', append_dim='Time')
+
+            n = max(n, i + part.sizes['Time'])
+
+        # Keep the state for the next append
+        zarr.open_group(fname, mode='a').attrs.update(ds.attrs)
+        zarr.consolidate_metadata(fname)
+
+    @measure('write')
+    def writeRegions(self, ds, fname):
+        """
+        Write the lazy report ds to zarr in one pass. The store is laid out
+        first, with coordinates, attributes and encodings. Then every
+        Time x SaCategory chunk is written as its own region, all of them in
+        parallel on the dask scheduler. The zarr chunks are the write regions,
+        so no two writers share a chunk, and the gridding that neighbouring
+        regions share is done once.
+        """
+        # Categories per gridder, all of them when fused
+        step = ds.sizes['SaCategory'] // len(self.gridders)
+        time_chunk = timeChunk(self.profile, max(ds['value'].chunks[ds['value'].get_axis_num('Time')]))
+
+        # The small variables without categories are written with the layout
+        Progress().setStage('write layout')
+        ds = ds.assign({k: ds[k].compute() for k in ds.data_vars if 'SaCategory' not in ds[k].dims})
+        ds = ds.assign_coords({k: ds[k].compute() for k in ds.coords if 'SaCategory' not in ds[k].dims})
+
+        # The Sa variables in chunks of the write regions
+        chunks = {'SaCategory': step, 'Time': time_chunk}
+        ds = ds.assign({k: ds[k].variable.chunk({dim: chunks[dim] for dim in chunks if dim in ds[k].dims})
+                        for k in ds.data_vars if 'SaCategory' in ds[k].dims})
+        ds.to_zarr(fname, mode='w', encoding=encoding(ds, self.profile, chunks), compute=False)
+
+        # One write task per chunk, the dask chunks are the zarr chunks
+        writes = []
+        for i0 in range(0, ds.sizes['SaCategory'], step):
+            region = ds.isel(SaCategory=slice(i0, i0 + step))
+            region = region.drop_vars([v for v in region.variables if 'SaCategory' not in region[v].dims])
+            writes.append(region.to_zarr(fname, region={'SaCategory': slice(i0, i0 + step)}, compute=False))
+
+        with Progress().step('write', Progress().pings):
+            dask.compute(*writes)
+
+    @measure('saveGridd')
     def saveGridd(self,fname):
 
         file_path, file_ext = os.path.splitext(fname)
         file_ext = file_ext.lower()
 
+        if file_ext == '.zarr' and self.ds is None and self.worker_data is not None and self.window is not None:
+            # Streamed straight into the report, without gridding the whole survey first
+            self.writeWindows(fname, self.has_out_file)
+            self.ds = xr.open_zarr(fname)
+            return
+
         if self.getGridd() is None:
             return
 
         if file_ext == '.zarr':
 
             if self.has_out_file:
-                self.ds.to_zarr(fname, mode='a', append_dim='time')
+                Log().info(f'Appending gridded data to : {fname}')
+                self.appendZarr(self.ds, fname, self.tail_index)
+                if self.pyramid:
+                    Progress().setStage('pyramid')
+                    updatePyramid(fname, self.tail_index)
+
+                # Read back what was written instead of gridding it again
+                self.ds = xr.open_zarr(fname).isel(Time=slice(self.tail_index, None))
             else:
-                compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
-                encoding = {var: {"compressor": compressor} for var in self.ds.data_vars}
                 Log().info(f'Writing gridded data to : {fname}')
-                self.ds.to_zarr(fname, mode='w', encoding=encoding)
+                self.writeRegions(self.ds, fname)
                 Log().info(f'Done writing file {fname}')
+                if self.pyramid:
+                    Progress().setStage('pyramid')
+                    updatePyramid(fname)
+
+                # Read back what was written instead of gridding it again
+                self.ds = xr.open_zarr(fname)
         else:
             Log().error('{} format not supported'.format(fname[-4:]))
 
-    def saveImages(self, fname):
+    @measure('saveImages')
+    def saveImages(self, fname, how='mean', processes=None):
+        """
+        .png : one echogram per category, fname_<category>.png. The values are pooled (how : 'max' or 'mean')
+               to the image pixels before the dB conversion, and the categories rendered in processes
+        """
 
         file_path, file_ext = os.path.splitext(fname)
         file_ext = file_ext.lower()
@@ -352,47 +654,19 @@ class Reportgenerator:
             return
 
         if file_ext == '.png':
-
-            vmax = -20
-            vmin = -80
-            for cat in self.ds['SaCategory']:
-                Log().info(f'Generating image for category : {cat.values.flatten()[0]}')
-                data = self.ds.sel(SaCategory=cat)
-
-                fig = plt.figure(figsize=(12, 6))
-                ax = plt.axes()
-                plt.title('{} @ {}'.format(cat.values, data['channel_id'].values))
-
-                # Set axis limits
-                x_lims = mdates.date2num(data['Time'].values)
-
-                extent = [x_lims[0], x_lims[-1].astype(float), data['ChannelDepthUpper'].values[-1],
-                          data['ChannelDepthUpper'].values[0]]
-
-                im = plt.gca().imshow(10 * np.log10(data['value'].transpose().values + 10e-20), vmin=vmin,vmax=vmax, extent=extent, origin='upper')
-
-                plt.ylabel('Sv {}(m)'.format(self.vtype))
-
-                # Format time axis
-                locator = mdates.AutoDateLocator(minticks=3, maxticks=20)
-                formatter = mdates.ConciseDateFormatter(locator)
-                plt.gca().xaxis.set_major_locator(locator)
-                plt.gca().xaxis.set_major_formatter(formatter)
-
-                plt.axis('auto')
-                plt.axis('tight')
-                plt.subplots_adjust(left=0.043, bottom=0.067, right=0.9, top=0.95)
-
-                # Make colorbar tighter
-                cax = fig.add_axes([ax.get_position().x1 + 0.01, ax.get_position().y0, 0.02, ax.get_position().height])
-                plt.colorbar(im, cax=cax)
-
-                plt.savefig('{}_{}.png'.format(file_path, cat.values))
-                plt.close()
+            Progress().setStage('images')
+            saveEchograms(self.ds, file_path, 'Sv {}(m)'.format(self.vtype), how, processes)
         else:
             Log().error('{} format not supported'.format(fname[-4:]))
 
-    def saveReport(self, fname):
+    @measure('saveReport')
+    def saveReport(self, fname, by_day=False, drop_zeros=False):
+        """
+        .csv     : one file per category, fname_<category>.csv
+        .parquet : one dataset directory, partitioned by category and with by_day by day.
+                   drop_zeros leaves out the cells without Sa
+        .xml     : ICES Acoustic
+        """
 
         file_path, file_ext = os.path.splitext(fname)
         file_ext = file_ext.lower()
@@ -400,27 +674,32 @@ class Reportgenerator:
         if self.getGridd() is None:
             return
 
+        Progress().setStage('report ' + file_ext)
         if file_ext == '.csv':
 
-            for cat in self.ds['SaCategory']:
-                ds = self.ds.sel(SaCategory=cat).copy()
-
+            for cat in self.ds['SaCategory'].values:
+                ds = self.ds.sel(SaCategory=cat)
                 ds['value'] = ds['value'] * 4 * np.pi * 1852**2 * self.vstep
-                df = self.ds.to_dataframe()
-                # Add the attributes to the df
-                for item in list(self.ds.attrs.items()):
-                    df[item[0]] = item[1]
-                # Save report to pandas tidy file
 
-                df.to_csv('{}_{}.csv'.format(file_path, cat.values), index=True)
+                writeCSV(ds, '{}_{}.csv'.format(file_path, cat))
+
+        elif file_ext == '.parquet':
+
+            ds = self.ds.assign(value=self.ds['value'] * 4 * np.pi * 1852**2 * self.vstep)
+            writeParquet(ds, fname, by_day=by_day, drop_zeros=drop_zeros)
+
+        elif file_ext == '.xml':
+
+            ds = self.ds.assign(value=self.ds['value'] * 4 * np.pi * 1852**2 * self.vstep)
+            writeICESAcoustic(ds, fname, sv_threshold=self.SvThreshold)
+        else:
+            Log().error('{} format not supported'.format(fname[-4:]))
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        tmpDir = Res().getTmpDir()
-        if os.path.exists(tmpDir):
-            shutil.rmtree(tmpDir)
+        pass
 
 
 """
@@ -458,10 +737,30 @@ if __name__ == "__main__":
     parser.add_argument("--hstep", type=float, help="Step unit for horizontal integration : #pings | seconds | nautical miles)")
     parser.add_argument("--vtype", type=str, choices=['range', 'depth'], help="Type of vertical integration")
     parser.add_argument("--vstep", type=float,help="Step unit for horizontal integration : meters")
+    parser.add_argument("--weight_cache", type=str, help="Directory for weight matrices reused between runs")
+    parser.add_argument("--fused", type=int, choices=[0, 1], default=1, help="Grid all categories in one pass over Sv")
+    parser.add_argument("--engine", type=str, choices=['matmul', 'direct'], default='matmul', help="Gridding engine")
+    parser.add_argument("--window", type=int, help="Grid and write this many Time bins at a time, bounds the memory use")
+    parser.add_argument("--parquet", type=int, choices=[0, 1], default=0, help="Also write the report as a parquet dataset partitioned by category")
+    parser.add_argument("--by_day", type=int, choices=[0, 1], default=0, help="Also partition the parquet dataset by day")
+    parser.add_argument("--drop_zeros", type=int, choices=[0, 1], default=0, help="Leave the empty cells out of the parquet dataset")
+    parser.add_argument("--xml", type=int, choices=[0, 1], default=0, help="Also write the report as ICES Acoustic xml")
+    parser.add_argument("--profile", type=str, choices=list(PROFILES), default='default', help="Encoding of the report store")
+    parser.add_argument("--pyramid", type=int, choices=[0, 1], default=0, help="Also write a multiscale pyramid of the report")
+    parser.add_argument("--cprofile", type=int, choices=[0, 1], default=0, help="Also profile the run with cProfile, to <out>_profile.prof")
+    parser.add_argument("--dask_report", type=int, choices=[0, 1], default=0, help="Also write a dask performance report, to <out>_dask.html (distributed scheduler)")
+    parser.add_argument("--progress_interval", type=float, default=60, help="Seconds between the progress reports in the log, 0 for none")
+    parser.add_argument("--progress_file", type=str, help="Also write the progress to this json file")
+    addSchedulerArguments(parser)
 
     args = parser.parse_args()
 
-    with Reportgenerator(
+    if args.weight_cache is not None:
+        WeightCache().setDiskDir(args.weight_cache)
+
+    # The run metrics are written to <out>_metrics.json
+    progress = ProgressReporter(args.progress_interval, args.progress_file) if args.progress_interval > 0 else nullcontext()
+    with Scheduler.fromArgs(args), progress, Instrument(args.out, bool(args.cprofile), bool(args.dask_report)), Reportgenerator(
         args.data,
         args.pred,
         args.bot,
@@ -474,26 +773,24 @@ if __name__ == "__main__":
         args.htype,
         args.hstep,
         args.depth_start,
-        args.depth_end
+        args.depth_end,
+        fused=bool(args.fused),
+        engine=args.engine,
+        window=args.window,
+        profile=args.profile,
+        pyramid=bool(args.pyramid)
     ) as rg:
 
         rg.saveGridd(args.out)
         rg.saveImages(args.img + '.png')
         rg.saveReport(args.out + '.csv')
+        if args.parquet:
+            rg.saveReport(args.out + '.parquet', by_day=bool(args.by_day), drop_zeros=bool(args.drop_zeros))
+        if args.xml:
+            rg.saveReport(args.out + '.xml')
 
         gridd = rg.getGridd()
         if gridd is not None:
-            dstDir = str(Path(args.out).parent)
-            for cat in gridd['SaCategory']:
-                Log().info(f'Generating integration image for category : {cat.values.flatten()[0]}')
-                sv = gridd.sel(SaCategory=cat.values)['value']
-
-                sum_sv = sv.sum(dim='ChannelDepthUpper')
-
-                sum_sv.plot()
-                if not os.path.exists(dstDir):
-                    os.makedirs(dstDir)
-                plt.savefig(dstDir+os.sep+f'cat_{cat.values.flatten()[0]}.png')
-                plt.close()
-
-
+            Log().info('Generating integration images')
+            Progress().setStage('integration images')
+            saveIntegrationImages(gridd, str(Path(args.out).parent))
@@ -0,0 +1,97 @@
+import os
+import dask
+from Logger import Logger as Log
+
+"""
+    Dask execution backend, configured from env vars or command line flags
+
+    SCHEDULER          : threads | processes | distributed | synchronous
+    N_WORKERS          : number of workers (processes for distributed/processes, threads for threads)
+    THREADS_PER_WORKER : threads in each distributed worker
+    MEMORY_LIMIT       : memory limit per distributed worker, e.g. 4GB, or auto
+    SPILL_DIR          : directory for data spilled to disk by the workers
+"""
+
+SCHEDULERS = ['threads', 'processes', 'distributed', 'synchronous']
+
+
+def _int(value):
+    return None if value in (None, '') else int(value)
+
+
+def addSchedulerArguments(parser, spill_dir=None):
+    """
+    Add the scheduler flags to an argparse parser, with the env vars as defaults
+    """
+    parser.add_argument("--scheduler", type=str, choices=SCHEDULERS,
+                        default=os.getenv('SCHEDULER', 'threads'), help="Dask scheduler")
+    parser.add_argument("--workers", type=int, default=_int(os.getenv('N_WORKERS')),
+                        help="Number of workers (default: number of cores)")
+    parser.add_argument("--threads_per_worker", type=int, default=_int(os.getenv('THREADS_PER_WORKER')),
+                        help="Threads per distributed worker")
+    parser.add_argument("--memory_limit", type=str, default=os.getenv('MEMORY_LIMIT', 'auto'),
+                        help="Memory limit per distributed worker, e.g. 4GB")
+    parser.add_argument("--spill_dir", type=str, default=os.getenv('SPILL_DIR', spill_dir),
+                        help="Directory for data spilled to disk")
+
+
+class Scheduler:
+    """
+    Context manager setting the dask scheduler for everything computed inside it.
+    """
+
+    def __init__(self, scheduler='threads', workers=None, threads_per_worker=None, memory_limit='auto', spill_dir=None):
+        if scheduler not in SCHEDULERS:
+            raise ValueError('{} scheduler not defined'.format(scheduler))
+
+        self.scheduler = scheduler
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.client = None
+        self.cluster = None
+        self.config = None
+
+    @classmethod
+    def fromArgs(cls, args):
+        return cls(args.scheduler, args.workers, args.threads_per_worker, args.memory_limit, args.spill_dir)
+
+    def __enter__(self):
+        config = {}
+        if self.spill_dir is not None:
+            if not os.path.exists(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            config['temporary_directory'] = self.spill_dir
+
+        scheduler = self.scheduler
+        if scheduler == 'distributed':
+            try:
+                from dask.distributed import Client, LocalCluster
+            except ImportError:
+                Log().error('dask.distributed is not installed, using the threads scheduler')
+                scheduler = 'threads'
+
+        if scheduler == 'distributed':
+            self.cluster = LocalCluster(n_workers=self.workers,
+                                        threads_per_worker=self.threads_per_worker,
+                                        memory_limit=self.memory_limit,
+                                        local_directory=self.spill_dir)
+            self.client = Client(self.cluster)
+            Log().info(f'Using distributed scheduler: {self.client}')
+        else:
+            if self.memory_limit not in (None, 'auto'):
+                Log().warning(f'Memory limit only applies to the distributed scheduler, not {scheduler}')
+            config['scheduler'] = scheduler
+            if self.workers is not None:
+                config['num_workers'] = self.workers
+            Log().info(f'Using {scheduler} scheduler, workers: {self.workers or "all cores"}')
+
+        self.config = dask.config.set(config)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.config.__exit__(type, value, traceback)
+        if self.client is not None:
+            self.client.close()
+            self.cluster.close()
@@ -0,0 +1,157 @@
+import os
+import uuid
+import shutil
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import zarr
+from scipy import sparse
+from Logger import Logger as Log
+from Resources import Singleton
+from Metrics import measure
+
+"""
+    Cache of the sparse regridding weights, keyed by a hash of the target and source bins
+"""
+
+# Bump when the weight construction changes, so old disk entries are not reused
+WEIGHT_VERSION = 1
+
+
+class WeightCache(Singleton):
+    """
+    Two layers:
+        memory - in-process LRU, capped by the size of the CSR arrays
+        disk   - optional, one zarr store per weight matrix in diskDir.
+                 The least recently used stores are evicted when the
+                 directory grows beyond maxDiskSize.
+    """
+
+    def init(self):
+        self.memory = OrderedDict()
+        self.memorySize = 0
+        self.maxMemorySize = 1024 ** 3
+        self.diskDir = None
+        self.maxDiskSize = 10 * 1024 ** 3
+
+    def setDiskDir(self, diskDir):
+        if diskDir is not None and not os.path.exists(diskDir):
+            os.makedirs(diskDir)
+        self.diskDir = diskDir
+
+    def getDiskDir(self):
+        return self.diskDir
+
+    def setMaxDiskSize(self, size):
+        self.maxDiskSize = size
+
+    def setMaxMemorySize(self, size):
+        self.maxMemorySize = size
+        self._evictMemory()
+
+    def clear(self):
+        self.memory.clear()
+        self.memorySize = 0
+
+    def key(self, r_t, r_s):
+        h = hashlib.sha1(str(WEIGHT_VERSION).encode())
+        for r in (r_t, r_s):
+            r = np.ascontiguousarray(r, dtype=float)
+            h.update(str(r.shape).encode())
+            h.update(r.tobytes())
+        return h.hexdigest()
+
+    @measure('weights')
+    def get(self, r_t, r_s, build, diskDir=None):
+        """
+        Return the weights for the target bins r_t and source bins r_s.
+        build(r_t, r_s) is only called on a miss in both layers.
+        diskDir overrides the configured disk layer, None uses the configured one.
+        """
+        key = self.key(r_t, r_s)
+        if diskDir is None:
+            diskDir = self.diskDir
+
+        W = self.memory.get(key)
+        if W is not None:
+            self.memory.move_to_end(key)
+            return W
+
+        if diskDir is not None:
+            W = self._getDisk(key, diskDir)
+
+        if W is None:
+            W = build(r_t, r_s)
+            if diskDir is not None:
+                self._putDisk(key, W, diskDir)
+        else:
+            Log().debug(f'Weight matrix {key} read from {diskDir}')
+
+        self._putMemory(key, W)
+        return W
+
+    def _nbytes(self, W):
+        return W.data.nbytes + W.indices.nbytes + W.indptr.nbytes
+
+    def _putMemory(self, key, W):
+        self.memory[key] = W
+        self.memorySize += self._nbytes(W)
+        self._evictMemory()
+
+    def _evictMemory(self):
+        # Always keep the newest entry, even if it alone is above the cap
+        while self.memorySize > self.maxMemorySize and len(self.memory) > 1:
+            _, W = self.memory.popitem(last=False)
+            self.memorySize -= self._nbytes(W)
+
+    def _getDisk(self, key, diskDir):
+        fname = diskDir + os.sep + key + '.zarr'
+        if not os.path.exists(fname):
+            return None
+        try:
+            group = zarr.open_group(store=zarr.DirectoryStore(fname), mode='r')
+            W = sparse.csr_matrix(
+                (group['data'][:], group['indices'][:], group['indptr'][:]),
+                shape=tuple(group.attrs['shape']))
+        except (KeyError, ValueError) as e:
+            Log().warning(f'Could not read cached weight matrix {fname}: {e}')
+            return None
+
+        # Mark as recently used
+        os.utime(fname)
+        return W
+
+    def _putDisk(self, key, W, diskDir):
+        fname = diskDir + os.sep + key + '.zarr'
+
+        # Write to a private name first, so concurrent runs never see a partial store
+        tmp_fname = diskDir + os.sep + '.' + key + '.' + str(uuid.uuid1())
+        group = zarr.group(store=zarr.DirectoryStore(tmp_fname), overwrite=True)
+        group.array('data', W.data, compressor=None)
+        group.array('indices', W.indices, compressor=None)
+        group.array('indptr', W.indptr, compressor=None)
+        group.attrs['shape'] = list(W.shape)
+        try:
+            os.rename(tmp_fname, fname)
+        except OSError:
+            # Another run stored the same weights meanwhile
+            shutil.rmtree(tmp_fname, ignore_errors=True)
+
+        self._evictDisk(diskDir)
+
+    def _evictDisk(self, diskDir):
+        stores = []
+        for name in os.listdir(diskDir):
+            fname = diskDir + os.sep + name
+            if name.startswith('.') or not name.endswith('.zarr'):
+                continue
+            size = sum(os.path.getsize(root + os.sep + f) for root, _, files in os.walk(fname) for f in files)
+            stores.append((os.path.getmtime(fname), size, fname))
+
+        total = sum(s[1] for s in stores)
+        for _, size, fname in sorted(stores):
+            if total <= self.maxDiskSize:
+                break
+            Log().debug(f'Evicting cached weight matrix {fname}')
+            shutil.rmtree(fname, ignore_errors=True)
+            total -= size
@@ -1,43 +1,218 @@
+import itertools
 import numpy as np
 import xarray as xr
 import dask
+from scipy import sparse
+from dask.base import tokenize
+from dask.highlevelgraph import HighLevelGraph
 #from NPGridder import NPGridder, GridType
 from ZarrGridder import ZarrGridder,GridType
+from DirectGridder import directIntegrate
+from Metrics import measure
 
 """
     Lossless griding on Xarrays    
 """
 
+
+def _sparseBlock(weights, edge, *blocks):
+    """
+    Apply the sparse weights to consecutive source chunks along the first axis
+    and sum the contributions. weights[k] is the part of W matching blocks[k].
+    """
+    gridded = None
+    for W, block in zip(weights, blocks):
+        shape = block.shape
+        part = W.dot(block.reshape(shape[0], -1)).reshape((W.shape[0],) + shape[1:])
+        gridded = part if gridded is None else gridded + part
+
+    gridded = np.asarray(gridded, dtype=float)
+    gridded[edge] = np.nan
+    return gridded
+
+
+def _directBlock(weights, edge, Wv, edge_v, *blocks):
+    """
+    Integrate consecutive (ping, ..., range) source chunks straight into the
+    (target ping, ..., target range) cells. weights[k] is the part of the
+    horizontal W matching blocks[k].
+    """
+    gridded = None
+    for Wh, block in zip(weights, blocks):
+        part = directIntegrate(Wh, Wv, block)
+        gridded = part if gridded is None else gridded + part
+
+    gridded[edge] = np.nan
+    gridded[..., edge_v] = np.nan
+    return gridded
+
+
 #class XGridder(NPGridder):
 class XGridder(ZarrGridder):
 
-    def __init__(self, target_v_bins=None, source_v_bins=None, target_h_bins=None, source_h_bins=None):
+    # 'matmul' : vertical then horizontal sparse product
+    # 'direct' : one pass over batches of pings into the output cells, see DirectGridder
+    engines = ['matmul', 'direct']
+
+    def __init__(self, target_v_bins=None, source_v_bins=None, target_h_bins=None, source_h_bins=None, engine='matmul'):
         super().__init__(target_v_bins, source_v_bins, target_h_bins, source_h_bins)
+        if engine not in self.engines:
+            raise ValueError('{} gridding engine not defined'.format(engine))
+        self.engine = engine
+
+    def _blockPlan(self, W, bounds):
+        """
+        Split the target bins (rows of W) into output chunks that follow the
+        source chunks given by bounds. Each target bin goes with the source
+        chunk holding its first non-zero weight, so an output chunk only
+        depends on the source chunks its bins overlap.
+        Returns a list of (row0, row1, chunk0, chunk1).
+        """
+        n_chunks = len(bounds) - 1
+        nnz = np.diff(W.indptr)
+        first = np.full(W.shape[0], -1)
+        last = np.full(W.shape[0], -1)
+        first[nnz > 0] = W.indices[W.indptr[:-1][nnz > 0]]
+        last[nnz > 0] = W.indices[W.indptr[1:][nnz > 0] - 1]
+
+        # Chunk of the first weight, empty (edge) rows follow the previous row
+        owner = np.searchsorted(bounds, first, side='right') - 1
+        owner[nnz == 0] = -1
+        owner = np.maximum.accumulate(np.maximum(owner, 0))
+
+        plan = []
+        splits = np.flatnonzero(np.diff(owner)) + 1
+        for r0, r1 in zip(np.append(0, splits), np.append(splits, W.shape[0])):
+            if np.any(nnz[r0:r1] > 0):
+                c0 = np.min(first[r0:r1][nnz[r0:r1] > 0])
+                c1 = np.max(last[r0:r1][nnz[r0:r1] > 0])
+                k0 = np.searchsorted(bounds, c0, side='right') - 1
+                k1 = np.searchsorted(bounds, c1, side='right')
+            else:
+                k0 = min(owner[r0], n_chunks - 1)
+                k1 = k0 + 1
+            plan.append((r0, r1, k0, k1))
+        return plan
 
     def _regrid(self, W, data):
-        # Regridd
+        """
+        Regrid the first axis of a dask array with the sparse W. The product is
+        built blockwise: each output chunk is the sum of the W sub-blocks times
+        the few source chunks it overlaps, so the memory scales with the number
+        of non-zeros in W and not with pings x bins.
+        """
+        if isinstance(data, xr.DataArray):
+            data = data.data
+        data = dask.array.asarray(data)
+
+        return self._blockwise(W, data, _sparseBlock, (), data.chunks[1:], 'sparse-regrid-')
+
+    def _directRegrid(self, WY, WX, data):
+        """
+        Grid (..., ping, range) in one pass per ping chunk with the direct engine,
+        the pings x target range intermediate is only formed a batch of pings at a time.
+        """
+        if isinstance(data, xr.DataArray):
+            data = data.data
+        data = dask.array.moveaxis(dask.array.asarray(data), -2, 0).rechunk({-1: -1})
+
+        Wv, edge_v = self._splitWeight(WX)
+        chunks = data.chunks[1:-1] + ((Wv.shape[0],),)
+        gridded = self._blockwise(WY, data, _directBlock, (Wv, edge_v), chunks, 'direct-regrid-')
+
+        return dask.array.moveaxis(gridded, 0, -2)
 
-        data_mod = dask.array.vstack((data, np.zeros(data.shape[1])))
+    def _blockwise(self, W, data, func, args, chunks, prefix):
+        """
+        Graph where output chunk j along the first axis is
+        func(W sub-blocks, edge bins, *args, *source chunks it overlaps).
+        chunks are the output chunks of the remaining axes, which follow the
+        chunks of the remaining source axes one to one.
+        """
+        W, edge = self._splitWeight(W)
+        bounds = np.cumsum((0,) + data.chunks[0])
+        plan = self._blockPlan(W, bounds)
 
-        return np.dot(W, data_mod)
+        name = prefix + tokenize(W.data, W.indices, W.indptr, edge, data.name, func, *args)
+        dsk = {}
+        for j, (r0, r1, k0, k1) in enumerate(plan):
+            Wj = W[r0:r1]
+            weights = [Wj[:, bounds[k]:bounds[k + 1]] for k in range(k0, k1)]
+            for idx in itertools.product(*[range(len(c)) for c in data.chunks[1:]]):
+                dsk[(name, j) + idx] = (func, weights, edge[r0:r1]) + tuple(args) + \
+                    tuple((data.name, k) + idx for k in range(k0, k1))
 
+        chunks = (tuple(r1 - r0 for r0, r1, _, _ in plan),) + tuple(chunks)
+        graph = HighLevelGraph.from_collections(name, dsk, dependencies=[data])
+        return dask.array.Array(graph, name, chunks, dtype=np.result_type(float, data.dtype))
+
+    def windows(self, size, start=0, stop=None):
+        """
+        Split the target horizontal bins start:stop into windows of size bins.
+        Returns a list of (bin0, bin1, ping0, ping1), where pings ping0:ping1 are
+        the source pings the bins of the window overlap. The windows follow the
+        bin edges, so each window can be gridded on its own.
+        """
+        W, _ = self._splitWeight(self._weight(self.target_h_bins.values, self.source_h_bins.values))
+        if stop is None:
+            stop = W.shape[0]
+
+        windows = []
+        for b0 in range(start, stop, size):
+            b1 = min(b0 + size, stop)
+            pings = W.indices[W.indptr[b0]:W.indptr[b1]]
+            if len(pings) == 0:
+                # Only edge bins, any ping will do
+                windows.append((b0, b1, 0, 1))
+            else:
+                windows.append((b0, b1, pings.min(), pings.max() + 1))
+        return windows
+
+    def _regrid2D(self, WX, WY, data):
+
+        if self.engine == 'direct':
+            griddedXY = self._directRegrid(WY, WX, data)
+        else:
+            griddedX = self._regrid(WX, data.transpose()).transpose()
+
+            # Pings are the second last axis, also with a leading category axis
+            griddedXY = self._regrid(WY, dask.array.moveaxis(griddedX, -2, 0))
+            griddedXY = dask.array.moveaxis(griddedXY, 0, -2)
+
+        # The output chunks follow the source chunks, zarr needs them uniform
+        griddedXY = griddedXY.rechunk({-2: max(griddedXY.chunks[-2])})
+
+        return griddedXY
+
+    @measure('regrid')
+    def regridWindow(self, data, window):
+        """
+        Regrid the target horizontal bins of one window from windows().
+        Only the source pings of the window are part of the graph.
+        """
+        b0, b1, p0, p1 = window
+        WX = self._weight(self.target_v_bins.values, self.source_v_bins.values)
+        WY = self._weight(self.target_h_bins.values, self.source_h_bins.values)
+
+        # Rows of the window and columns of its pings, keeping the edge column last
+        WY = sparse.hstack([WY[b0:b1, p0:p1], WY[b0:b1, -1:]], format='csr')
+
+        return self._regrid2D(WX, WY, data[..., p0:p1, :])
+
+    @measure('regrid')
     def regrid(self, data):
 
         if self.griddType == GridType.OneDimension:
-            W = self._resampleWeight(self.target_v_bins.values, self.source_v_bins.values)
+            W = self._weight(self.target_v_bins.values, self.source_v_bins.values)
             gridded = self._regrid(W, data.transpose()).transpose()
 
             return gridded
 
         elif self.griddType == GridType.TwoDimension:
-            WX = self._resampleWeight(self.target_v_bins.values, self.source_v_bins.values)
-            griddedX = self._regrid(WX, data.transpose()).transpose()
-
-            WY = self._resampleWeight(self.target_h_bins.values, self.source_h_bins.values)
-            griddedXY = self._regrid(WY, griddedX)
-
-            return griddedXY
+            WX = self._weight(self.target_v_bins.values, self.source_v_bins.values)
+            WY = self._weight(self.target_h_bins.values, self.source_h_bins.values)
 
+            return self._regrid2D(WX, WY, data)
 
 
 if __name__ == "__main__":
@@ -1,182 +1,16 @@
-import zarr
-from enum import Enum, auto
 import numpy as np
-import uuid
-import os
-from Resources import Resources as Res
-
-
-class GridType(Enum):
-    OneDimension = auto()
-    TwoDimension = auto()
+from NPGridder import NPGridder, GridType
 
 """
-    Lossless griding on numpy arrays
+    Lossless griding on numpy arrays, the NPGridder base of XGridder.
+    The weights are kept in WeightCache, in memory and on disk when configured, for all gridders.
     Based on : https://github.com/CRIMAC-WP4-Machine-learning/CRIMAC-preprocessing/blob/master/CRIMAC_preprocess.py
 """
 
-class ZarrGridder:
+class ZarrGridder(NPGridder):
     # target_v_bins, source_v_bins, target_h_bins, source_h_bins
     def __init__(self, target_v_bins=None, source_v_bins=None, target_h_bins=None, source_h_bins=None):
-
-        self.source_v_bins = source_v_bins
-        self.source_h_bins = source_h_bins
-        self.target_v_bins = target_v_bins
-        self.target_h_bins = target_h_bins
-
-        if source_h_bins is None or target_h_bins is None:
-            self.griddType = GridType.OneDimension
-        else:
-            self.griddType = GridType.TwoDimension
-
-        self.storageDir = Res().getTmpDir() + os.sep + '__tmp_W'
-
-    def _resampleWeight(self, r_t, r_s):
-        """
-        Input :
-            r_t - Target (Sample vector)
-            r_s - Source range vector - Binning we end up with
-
-        The regridding is a linear combination of the inputs based
-        on the fraction of the source bins to the range bins.
-        See the different cases below
-        """
-
-        # Create target bins from target range
-        bin_r_t = np.append(r_t[0] - (r_t[1] - r_t[0]) / 2, (r_t[0:-1] + r_t[1:]) / 2)
-        bin_r_t = np.append(bin_r_t, r_t[-1] + (r_t[-1] - r_t[-2]) / 2)
-
-        # Create source bins from source range
-        bin_r_s = np.append(r_s[0] - (r_s[1] - r_s[0]) / 2, (r_s[0:-1] + r_s[1:]) / 2)
-        bin_r_s = np.append(bin_r_s, r_s[-1] + (r_s[-1] - r_s[-2]) / 2)
-
-        # Initialize W matrix (sparse)
-        fname = self.storageDir+os.sep+str(uuid.uuid1())+'.zarr'
-        store = zarr.DirectoryStore(fname)
-
-        #  3.57 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, 75), store=store, overwrite=True, compressor=None)
-
-        #  1.56 min
-        W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, 50), store=store, overwrite=True, compressor=None)
-
-        #  1.57 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, 40), store=store, overwrite=True, compressor=None)
-
-        #  1.58 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, 30), store=store, overwrite=True, compressor=None)
-
-        #  2.52 min
-        # W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(20, 20), store=store, overwrite=True, compressor=None)
-
-        #  3.31 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(5, 20), store=store, overwrite=True, compressor=None)
-
-        #  6.08min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(1, 20), store=store, overwrite=True, compressor=None)
-        #  2.05 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, 20), store=store, overwrite=True, compressor=None)
-
-        #  2.19 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(25, 50), store=store, overwrite=True, compressor=None)
-        #  5.07 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(25, 25), store=store, overwrite=True, compressor=None)
-        #  4.09min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(50, 100), store=store, overwrite=True, compressor=None)
-        # 6.07 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(100, 50), store=store, overwrite=True, compressor=None)
-        # 3.33 min
-        # W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(50,50), store=store, overwrite=True, compressor=None)
-        # Mor than 10 min
-        #W = zarr.zeros((len(r_t), len(r_s) + 1), chunks=(10, (len(r_s) + 1)//10), store=store, overwrite=True, compressor=None)
-
-
-        # Loop over the target bins
-        for i, rt in enumerate(r_t):
-
-            # Check that this is not an edge case
-            if bin_r_t[i] > bin_r_s[0] and bin_r_t[i + 1] < bin_r_s[-1]:
-                # The size of the target bin
-                # example target bin:  --[---[---[---[-
-                drt = bin_r_t[i + 1] - bin_r_t[i]  # From example: drt = 4
-
-                # find the indices in source
-                j0 = np.searchsorted(bin_r_s, bin_r_t[i], side='right') - 1
-                j1 = np.searchsorted(bin_r_s, bin_r_t[i + 1], side='right')
-
-                # CASE 1: Target higher resolution, overlapping 1 source bin
-                # target idx     i    i+1
-                # target    -----[-----[-----
-                # source    --[-----------[--
-                # source idx  j0          j1
-
-                if j1 - j0 == 1:
-                    W[i, j0] = 1
-
-                # CASE 2: Target higher resolution, overlapping 1 source bin
-                # target idx      i   i+1
-                # target    --[---[---[---[-
-                # source    -[------[------[-
-                # source idx j0            j1
-
-                elif j1 - j0 == 2:
-                    W[i, j0] = (bin_r_s[j0 + 1] - bin_r_t[i]) / drt
-                    W[i, j1 - 1] = (bin_r_t[i + 1] - bin_r_s[j1 - 1]) / drt
-
-                # CASE 3: Target lower resolution
-                # target idx    i       i+1
-                # target    ----[-------[----
-                # source    --[---[---[---[--
-                # source idx  j0          j1
-
-                elif j1 - j0 > 2:
-                    for j in range(j0, j1):
-                        if j == j0:
-                            W[i, j] = (bin_r_s[j + 1] - bin_r_t[i]) / drt
-                        elif j == j1 - 1:
-                            W[i, j] = (bin_r_t[i + 1] - bin_r_s[j]) / drt
-                        else:
-                            W[i, j] = (bin_r_s[j + 1] - bin_r_s[j]) / drt
-
-            #  Edge case 1
-            # target idx    i       i+1
-            # target    ----[-------[----
-            # source        #end# [---[---[
-            # source idx          j0  j1
-
-            #  Edge case 2
-            # target idx    i       i+1
-            # target    ----[-------[----
-            # source    --[---[ #end#
-            # source idx  j0  j1
-            else:
-                # Edge case (NaN must be in W, not in sv_s.
-                # Or else np.dot failed)
-                W[i, -1] = np.nan
-        return W
-
-
-    def _regrid(self, W, data):
-        # Regridd
-        data_mod = np.vstack((data, np.zeros(data.shape[1])))
-        return np.dot(W, data_mod)
-
-    def regrid(self, data):
-
-        if self.griddType == GridType.OneDimension:
-            W = self._resampleWeight(self.target_v_bins, self.source_v_bins)
-            data = self._regrid(W, data.T).T
-
-            return data
-
-        elif self.griddType == GridType.TwoDimension:
-            W = self._resampleWeight(self.target_v_bins, self.source_v_bins)
-            data = self._regrid(W, data.T).T
-
-            W = self._resampleWeight(self.target_h_bins, self.source_h_bins)
-            data = self._regrid(W, data)
-
-            return data
+        super().__init__(target_v_bins, source_v_bins, target_h_bins, source_h_bins)
 
 
 if __name__ == "__main__":
@@ -121,3 +121,10 @@ fig, axes = plt.subplots(nrows=2)
 Sa_int.plot(ax=axes[0])
 Sa_raw.plot(ax=axes[1])
 plt.savefig(report_file_name+'_sv.png')
+
+# Comparing the integrator with LSSS, per category, depth and log
+import Compare
+
+summary = Compare.compare(report, Compare.loadLSSS(LSSS_report_file_name, main_freq))
+Compare.writeSummary(summary, report_file_name + '_compare.json', logs=True)
+print(summary['category'].to_dataframe())